@@ -0,0 +1,427 @@
+import argparse
+import csv
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+# Load generator and benchmark harness for the Bazar services.
+#
+# By default it starts catalog, order and frontend servers on local ports, each on
+# a private copy of the data files, drives a mix of /search, /info and /purchase
+# requests at the frontend and stops them again. --frontend-url benchmarks
+# servers that are already running instead.
+#
+# Closed loop (--concurrency N): N clients each send a request as soon as their
+# previous one is answered. Open loop (--rate R): requests arrive at R per second
+# (Poisson arrivals) whatever the response times, and latency is measured from
+# when a request was due, so a server that falls behind is not flattered by it.
+#
+#   python benchmark/bench.py --mix search=6,info=3,purchase=1 --concurrency 16 --duration 30 --output new.json
+#   python benchmark/bench.py --rate 500 --output new.json --compare old.json
+#
+# The results (throughput, p50/p95/p99 latency per request type, cache hit ratio)
+# are printed and, with --output, saved as JSON. --compare reports every metric
+# that got worse by more than --tolerance against a saved run and exits with 1.
+
+SERVICES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+OPERATIONS = ('search', 'info', 'purchase')
+
+# Percentiles reported for every request type
+PERCENTILES = (50, 95, 99)
+
+
+# Topics and item numbers to draw requests from, read from the catalog snapshot
+def load_workload(catalog_csv):
+    with open(catalog_csv, 'r') as csvfile:
+        rows = list(csv.DictReader(csvfile))
+    topics = sorted({row['Topic'] for row in rows if row.get('Topic')})
+    item_numbers = [row['ID'] for row in rows]
+    return topics, item_numbers
+
+
+# Parse 'search=6,info=3,purchase=1' into {operation: weight}
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f'Unknown request type {name.strip()!r}')
+        mix[name.strip()] = float(weight or 1)
+    if not any(weight > 0 for weight in mix.values()):
+        raise argparse.ArgumentTypeError('The mix needs at least one positive weight')
+    return mix
+
+
+# Nearest-rank percentile of an ascending list
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(p / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+# Catalog, order and frontend servers started as local processes for one run.
+#
+# Every server gets its own copy of the data files in a temporary directory, so
+# benchmark purchases never touch the checked-in CSVs, and its output goes to a
+# log file there. stop() terminates them (SIGTERM, so they leave their groups)
+# and removes the directory unless `keep` is set.
+class LocalServices:
+    def __init__(self, base_port, catalog_replicas, order_replicas, frontend='sync', keep=False):
+        self.workdir = tempfile.mkdtemp(prefix='bazar-bench-')
+        self.keep = keep
+        self.processes = []
+        catalog_urls = [f'http://localhost:{base_port + i}' for i in range(catalog_replicas)]
+        order_urls = [f'http://localhost:{base_port + 10 + i}' for i in range(order_replicas)]
+        self.frontend_url = f'http://localhost:{base_port + 20}'
+        common = {'FRONTEND_URLS': self.frontend_url, 'PYTHONUNBUFFERED': '1'}
+
+        for i, url in enumerate(catalog_urls):
+            catalog_csv = self._copy('catalog_server/catalog.csv', f'catalog{i + 1}.csv')
+            self._start('catalog_server/catalog.py', f'catalog{i + 1}', dict(
+                common, PORT=url.rsplit(':', 1)[1], REPLICA_SERVER_ID=str(i + 1), ADVERTISED_URL=url,
+                CATALOG_CSV=catalog_csv, CATALOG_PEER_URLS=','.join(catalog_urls), CATALOG_PRIMARY_URL=catalog_urls[0]))
+        for i, url in enumerate(order_urls):
+            order_csv = self._copy('order_server/order.csv', f'order{i + 1}.csv')
+            self._start('order_server/order.py', f'order{i + 1}', dict(
+                common, PORT=url.rsplit(':', 1)[1], REPLICA_SERVER_ID=str(i + 1), ADVERTISED_URL=url,
+                ORDER_CSV=order_csv, ORDER_PEER_URLS=','.join(order_urls), CATALOG_SERVER_URL=catalog_urls[0]))
+        script = 'frontend_server/frontend_async.py' if frontend == 'async' else 'frontend_server/frontend.py'
+        self._start(script, 'frontend', dict(
+            common, PORT=str(base_port + 20), CATALOG_SERVER_URLS=','.join(catalog_urls),
+            ORDER_SERVER_URLS=','.join(order_urls)))
+
+        self.health_urls = ([f'{url}/health' for url in catalog_urls + order_urls] +
+                            [f'{self.frontend_url}/cache_stats'])
+
+    def _copy(self, relative_path, name):
+        target = os.path.join(self.workdir, name)
+        shutil.copyfile(os.path.join(SERVICES_DIR, relative_path), target)
+        return target
+
+    def _start(self, relative_path, name, env):
+        log = open(os.path.join(self.workdir, f'{name}.log'), 'w')
+        script = os.path.join(SERVICES_DIR, relative_path)
+        process = subprocess.Popen([sys.executable, script], cwd=os.path.dirname(script),
+                                   env=dict(os.environ, **env), stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append((name, process, log))
+
+    # Block until every server answers, or raise RuntimeError after `timeout` seconds
+    def wait_ready(self, timeout=30.0):
+        deadline = time.monotonic() + timeout
+        pending = list(self.health_urls)
+        while pending:
+            for name, process, _ in self.processes:
+                if process.poll() is not None:
+                    raise RuntimeError(f'{name} exited with status {process.returncode}; see {self.workdir}/{name}.log')
+            try:
+                if requests.get(pending[0], timeout=1.0).status_code == 200:
+                    pending.pop(0)
+                    continue
+            except requests.exceptions.RequestException:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f'{pending[0]} did not come up within {timeout} seconds; logs are in {self.workdir}')
+            time.sleep(0.2)
+
+    def stop(self):
+        for _, process, _ in self.processes:
+            process.terminate()
+        for _, process, log in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            log.close()
+        if self.keep:
+            print(f'Server logs kept in {self.workdir}')
+        else:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+# Latencies and outcomes of the requests sent during the measurement window, per request type
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {operation: [] for operation in OPERATIONS}
+        # Requests that got no answer or an HTTP error
+        self.errors = {operation: 0 for operation in OPERATIONS}
+        # Requests answered with {'error': ...}, e.g. a purchase of a book out of stock
+        self.rejected = {operation: 0 for operation in OPERATIONS}
+
+    def record(self, operation, latency, outcome):
+        with self.lock:
+            if outcome == 'error':
+                self.errors[operation] += 1
+                return
+            self.latencies[operation].append(latency)
+            if outcome == 'rejected':
+                self.rejected[operation] += 1
+
+    # Summary over `elapsed` seconds, per request type and for all of them together
+    def summary(self, elapsed):
+        with self.lock:
+            per_operation = {operation: self._summarize(self.latencies[operation], self.errors[operation],
+                                                        self.rejected[operation], elapsed)
+                             for operation in OPERATIONS if self.latencies[operation] or self.errors[operation]}
+            everything = [latency for latencies in self.latencies.values() for latency in latencies]
+            per_operation['overall'] = self._summarize(everything, sum(self.errors.values()),
+                                                       sum(self.rejected.values()), elapsed)
+            return per_operation
+
+    @staticmethod
+    def _summarize(latencies, errors, rejected, elapsed):
+        latencies = sorted(latencies)
+        summary = {
+            'requests': len(latencies) + errors,
+            'errors': errors,
+            'rejected': rejected,
+            'throughput': round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+            'latency_ms': {
+                'mean': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+                'max': round(latencies[-1] * 1000, 3) if latencies else None
+            }
+        }
+        for p in PERCENTILES:
+            value = percentile(latencies, p)
+            summary['latency_ms'][f'p{p}'] = None if value is None else round(value * 1000, 3)
+        return summary
+
+
+# Drives requests at one frontend. Every thread keeps its own keep-alive session.
+class LoadGenerator:
+    def __init__(self, frontend_url, mix, topics, item_numbers, timeout=10.0, seed=None):
+        self.frontend_url = frontend_url.rstrip('/')
+        self.operations = list(mix)
+        self.weights = [mix[operation] for operation in self.operations]
+        self.topics = topics
+        self.item_numbers = item_numbers
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.local = threading.local()
+        self.recorder = Recorder()
+        # Requests started before this time.monotonic() value are warm-up and not recorded
+        self.record_after = 0.0
+
+    def _session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    # The next request to send, as (operation, method, path)
+    def next_request(self):
+        with self.random_lock:
+            operation = self.random.choices(self.operations, self.weights)[0]
+            if operation == 'search':
+                return operation, 'GET', f'/search/{self.random.choice(self.topics)}'
+            item_number = self.random.choice(self.item_numbers)
+            if operation == 'info':
+                return operation, 'GET', f'/info/{item_number}'
+            return operation, 'POST', f'/purchase/{item_number}'
+
+    # Send one request and record how long it took since `started` (default: now)
+    def send(self, operation, method, path, started=None):
+        started = time.monotonic() if started is None else started
+        try:
+            response = self._session().request(method, f'{self.frontend_url}{path}', timeout=self.timeout)
+            body = response.json() if response.status_code < 400 else None
+            outcome = 'error' if body is None else 'rejected' if isinstance(body, dict) and 'error' in body else 'ok'
+        except (requests.exceptions.RequestException, ValueError):
+            outcome = 'error'
+        if started >= self.record_after:
+            self.recorder.record(operation, time.monotonic() - started, outcome)
+
+    # `concurrency` clients sending back to back for `duration` seconds after `warmup`
+    def run_closed_loop(self, concurrency, duration, warmup):
+        self.record_after = time.monotonic() + warmup
+        end = self.record_after + duration
+
+        def client():
+            while time.monotonic() < end:
+                self.send(*self.next_request())
+
+        threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return duration
+
+    # Requests arriving at `rate` per second for `duration` seconds after `warmup`,
+    # sent by up to `max_in_flight` threads
+    def run_open_loop(self, rate, duration, warmup, max_in_flight):
+        start = time.monotonic()
+        self.record_after = start + warmup
+        end = self.record_after + duration
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            due = start
+            while due < end:
+                due += self.random.expovariate(rate)
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.send, *self.next_request(), started=due)
+        return duration
+
+    # Frontend cache counters, or None if it does not report them
+    def cache_stats(self):
+        try:
+            return self._session().get(f'{self.frontend_url}/cache_stats', timeout=self.timeout).json()
+        except (requests.exceptions.RequestException, ValueError):
+            return None
+
+
+# Hit ratio per cache namespace and overall between two /cache_stats snapshots
+def cache_hit_ratios(before, after):
+    if not before or not after:
+        return None
+    ratios = {}
+    total_hits = total_lookups = 0
+    for namespace in ('info', 'search'):
+        hits = after[namespace]['hits'] - before[namespace]['hits']
+        lookups = hits + after[namespace]['misses'] - before[namespace]['misses']
+        ratios[namespace] = round(hits / lookups, 4) if lookups else None
+        total_hits += hits
+        total_lookups += lookups
+    ratios['overall'] = round(total_hits / total_lookups, 4) if total_lookups else None
+    return ratios
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SERVICES_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Regressions of `current` against `baseline`: throughput lower, or latency
+# percentiles higher, by more than `tolerance` (a fraction). Returns readable lines.
+def compare(baseline, current, tolerance):
+    regressions = []
+    for operation, now in current['results'].items():
+        before = baseline.get('results', {}).get(operation)
+        if before is None:
+            continue
+        if before['throughput'] and now['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append(f'{operation}: throughput {before["throughput"]} -> {now["throughput"]} req/s')
+        for p in PERCENTILES:
+            old, new = before['latency_ms'].get(f'p{p}'), now['latency_ms'].get(f'p{p}')
+            if old and new and new > old * (1 + tolerance):
+                regressions.append(f'{operation}: p{p} latency {old} -> {new} ms')
+    return regressions
+
+
+def print_report(report):
+    print(f'{"request":<10}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"errors":>8}{"rejected":>10}')
+    for operation, summary in report['results'].items():
+        latency = summary['latency_ms']
+        print(f'{operation:<10}{summary["throughput"]:>10}' +
+              ''.join(f'{"-" if latency[f"p{p}"] is None else latency[f"p{p}"]:>10}' for p in PERCENTILES) +
+              f'{summary["errors"]:>8}{summary["rejected"]:>10}')
+    if report['cache'] is not None:
+        print(f'cache hit ratio: {report["cache"]}')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Bazar services.')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('search=6,info=3,purchase=1'),
+                        help='request types and their weights (default: search=6,info=3,purchase=1)')
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument('--concurrency', type=int, default=8, help='closed loop: number of clients (default: 8)')
+    load.add_argument('--rate', type=float, help='open loop: requests per second')
+    parser.add_argument('--max-in-flight', type=int, default=256,
+                        help='open loop: most requests in flight at once (default: 256)')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds measured (default: 20)')
+    parser.add_argument('--warmup', type=float, default=3.0, help='seconds run before measuring (default: 3)')
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds per request (default: 10)')
+    parser.add_argument('--seed', type=int, help='random seed for the request sequence')
+    parser.add_argument('--frontend-url', help='benchmark a running frontend instead of starting the services')
+    parser.add_argument('--frontend', choices=('sync', 'async'), default='sync',
+                        help='frontend to start: frontend.py or frontend_async.py (default: sync)')
+    parser.add_argument('--catalog-replicas', type=int, default=2)
+    parser.add_argument('--order-replicas', type=int, default=2)
+    parser.add_argument('--base-port', type=int, default=15000,
+                        help='catalog servers listen from this port, order servers from +10, the frontend on +20')
+    parser.add_argument('--keep-logs', action='store_true', help='keep the started servers\' logs')
+    parser.add_argument('--output', help='save the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative change counted as a regression (default: 0.1)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    topics, item_numbers = load_workload(os.path.join(SERVICES_DIR, 'catalog_server', 'catalog.csv'))
+
+    services = None
+    frontend_url = args.frontend_url
+    if frontend_url is None:
+        services = LocalServices(args.base_port, args.catalog_replicas, args.order_replicas, args.frontend,
+                                 keep=args.keep_logs)
+        frontend_url = services.frontend_url
+    try:
+        if services is not None:
+            services.wait_ready()
+        generator = LoadGenerator(frontend_url, args.mix, topics, item_numbers, args.timeout, args.seed)
+        before = generator.cache_stats()
+        if args.rate:
+            elapsed = generator.run_open_loop(args.rate, args.duration, args.warmup, args.max_in_flight)
+        else:
+            elapsed = generator.run_closed_loop(args.concurrency, args.duration, args.warmup)
+        after = generator.cache_stats()
+    finally:
+        if services is not None:
+            services.stop()
+
+    report = {
+        'timestamp': datetime.utcnow().isoformat(),
+        'commit': git_commit(),
+        'config': {
+            'mix': args.mix,
+            'mode': 'open' if args.rate else 'closed',
+            'rate': args.rate,
+            'concurrency': None if args.rate else args.concurrency,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'frontend': args.frontend if args.frontend_url is None else args.frontend_url,
+            'catalog_replicas': args.catalog_replicas,
+            'order_replicas': args.order_replicas
+        },
+        'results': generator.recorder.summary(elapsed),
+        # Includes the warm-up requests
+        'cache': cache_hit_ratios(before, after)
+    }
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(json.load(baseline_file), report, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            return 1
+        print(f'No regressions against {args.compare}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,148 +1,489 @@
-import csv
-from flask import Flask, jsonify, request
+import logging
+import math
+import os
+import sys
+import threading
+from flask import Flask, Response, jsonify, request
 import requests
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import http_client
+from common.serving import serve
+from common.resilience import propagate_deadlines
+from common.metrics import collect, instrument
+from common.logs import log_routes, log_sampled, setup_logging
+from common.tracing import span, trace_requests
+from common.config import url_list
+from common.journal import Journal
+from common.invalidation import InvalidationPublisher, FRONTEND_URLS
+from common.membership import Membership, add_membership_routes
+from common.session import SESSION_HEADER, format_token, parse_token
+from catalog_store import Book, CatalogStore, SEARCH_FIELDS
+from replication import AppliedOffsets, ReplicaSender, ReplicationLog, REPLICATION_QUORUM, offset_record, required_acks, \
+    wait_for_quorum
+
 app = Flask(__name__)
+log = logging.getLogger('catalog')
 
-# Load catalog data from a CSV file
-catalog = []
+# Latency and in-flight metrics for every route, served at /metrics
+instrument(app)
 
-# Load catalog data from the 'catalog.csv' file
-def load_catalog():
-    global catalog  
-    with open('catalog.csv', 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        catalog = list(reader)
+# Every request gets a deadline that bounds the calls it makes to other servers
+propagate_deadlines(app)
+
+# Every catalog replica runs this same server; its identity, data files and peers come from the environment.
+
+# Identity of this server, used in log lines
+replica_server_id = int(os.environ.get('REPLICA_SERVER_ID', '1'))
+replica_server_port = int(os.environ.get('PORT', '5000'))
+
+# Structured log records, written off the request threads (see common/logs.py)
+setup_logging(f'catalog{replica_server_id}')
+log_routes(app)
+
+# A span for every request, continuing the caller's trace (see common/tracing.py)
+trace_requests(app, f'catalog{replica_server_id}')
+
+# URL the other servers reach this one at; also its source ID in the replication stream
+SELF_URL = os.environ.get('ADVERTISED_URL', f'http://localhost:{replica_server_port}').rstrip('/')
+
+# The one replica that makes writes; the others forward /update and /decrement requests to it.
+# Every book's versions then come from a single sequence, so replicas never make two
+# different changes under the same version and all of them apply the changes in one order.
+CATALOG_PRIMARY_URL = os.environ.get('CATALOG_PRIMARY_URL', 'http://localhost:5000').rstrip('/')
+IS_PRIMARY = SELF_URL == CATALOG_PRIMARY_URL
+
+# Catalog snapshot of this replica, and the journal of the updates applied since it
+CATALOG_CSV = os.environ.get('CATALOG_CSV', 'catalog.csv')
+CATALOG_JOURNAL = os.environ.get('CATALOG_JOURNAL', os.path.splitext(CATALOG_CSV)[0] + '.journal')
+
+# Offsets applied from the peers' replication streams as of the CATALOG_CSV snapshot
+CATALOG_OFFSETS = os.environ.get('CATALOG_OFFSETS', os.path.splitext(CATALOG_CSV)[0] + '.offsets.json')
+
+# In-memory catalog store, indexed by book ID
+catalog = CatalogStore()
+
+# Journal of catalog updates applied since the last CATALOG_CSV snapshot
+journal = Journal(CATALOG_JOURNAL,
+                  fsync_interval=float(os.environ.get('JOURNAL_FSYNC_INTERVAL', '0.005')),
+                  compact_every=int(os.environ.get('JOURNAL_COMPACT_EVERY', '1000')))
 
-# Save catalog data to the 'catalog.csv' file
+# Sequenced log of the changes made on this server, and the position applied from each peer's log
+replication_log = ReplicationLog()
+applied_offsets = AppliedOffsets()
+
+# Seconds a read waits for this server to apply the writes named in the client's session token
+SESSION_READ_WAIT = float(os.environ.get('SESSION_READ_WAIT', '0.2'))
+
+# Notified whenever changes from a peer are applied, so reads waiting on a session can go on
+replicated = threading.Condition()
+
+# Load the CATALOG_CSV snapshot and the CATALOG_OFFSETS saved with it, and replay the
+# updates and replication offsets journaled after them
+def load_catalog():
+    catalog.load(CATALOG_CSV)
+    applied_offsets.load(CATALOG_OFFSETS)
+    for record in journal.replay():
+        if 'source' in record:
+            applied_offsets.set(record['source'], record['epoch'], record['applied'])
+        else:
+            catalog.update(record['id'], record.get('quantity'), record.get('price'), version=record.get('version'))
+
+# Snapshot the catalog to CATALOG_CSV and the replication offsets to CATALOG_OFFSETS,
+# and empty the journal. The offsets are written last, so they never include changes
+# the snapshot lacks.
 def save_catalog():
-    with open('catalog.csv', 'w', newline='') as csvfile:
-        fieldnames = ['ID', 'Title', 'Quantity', 'Price', 'Topic']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(catalog)
+    def write_snapshot():
+        catalog.save(CATALOG_CSV)
+        applied_offsets.save(CATALOG_OFFSETS)
+
+    with catalog.lock:
+        journal.compact(write_snapshot)
+
+# Journal entry holding a book's current values
+def journal_record(book):
+    return {'id': book.id, 'quantity': book.quantity, 'price': book.price, 'version': book.version}
+
+# Apply an update to the store and append it to the journal.
+# Returns the updated book once the journal entry is durable, or None if the book does not exist.
+def apply_update(item_number, quantity=None, price=None, version=None):
+    with catalog.lock:
+        book = catalog.update(item_number, quantity, price, version=version)
+        if book is None:
+            return None
+        # Journal and log for replication while holding the store lock so records keep the update order
+        seq = journal.append(journal_record(book), durable=False)
+        replicated_seq = replication_log.append([book])
+    journal.wait_durable(seq)
+    if journal.needs_compaction():
+        save_catalog()
+    wait_for_replicas(replicated_seq)
+    return book
+
+# Atomically take stock for one book (compare-and-set when `expected` is given) and journal it.
+# Returns (book, error) as CatalogStore.decrement() does, once the journal entry is durable.
+def apply_decrement(item_number, count=1, expected=None):
+    with catalog.lock:
+        book, error = catalog.decrement(item_number, count, expected)
+        if error is not None:
+            return book, error
+        seq = journal.append(journal_record(book), durable=False)
+        replicated_seq = replication_log.append([book])
+    journal.wait_durable(seq)
+    if journal.needs_compaction():
+        save_catalog()
+    wait_for_replicas(replicated_seq)
+    return book, None
+
+# Take stock for several books at once and journal every changed book with a single fsync.
+# Returns the per-book results of CatalogStore.decrement_many().
+def apply_decrements(counts):
+    with catalog.lock:
+        results = catalog.decrement_many(counts)
+        changed = [catalog.get(item_number) for item_number, result in results.items() if result.get('granted')]
+        if not changed:
+            return results
+        seq = journal.append_many([journal_record(book) for book in changed], durable=False)
+        replicated_seq = replication_log.append(changed)
+    journal.wait_durable(seq)
+    if journal.needs_compaction():
+        save_catalog()
+    wait_for_replicas(replicated_seq)
+    return results
+
+# Apply changes received from `source`'s replication stream, up to `seq` in `epoch`, and
+# journal them together with that offset; they are not replicated any further.
+# Each change holds 'id' and 'version' and any of 'quantity', 'price', 'title' and 'topic';
+# changes that are not newer than the book are skipped by CatalogStore.update().
+def apply_replicated(changes, source, epoch, seq):
+    with catalog.lock:
+        changed = []
+        for change in changes:
+            book = catalog.update(change['id'], change.get('quantity'), change.get('price'),
+                                  change.get('title'), change.get('topic'), version=change.get('version'))
+            if book is not None:
+                changed.append(book)
+        applied_offsets.set(source, epoch, seq)
+        # The offset goes after the changes in the same write, so a torn write never leaves it ahead of them
+        records = [journal_record(book) for book in changed] + [offset_record(source, epoch, seq)]
+        journal_seq = journal.append_many(records, durable=False)
+    with replicated:
+        replicated.notify_all()
+    journal.wait_durable(journal_seq)
+    if journal.needs_compaction():
+        save_catalog()
+    return changed
 
 load_catalog()
 
-# Invalidate the cache in the frontend server for the given item number
-def invalidate_frontend_cache(item_number):
+# The catalog rows together with the replication log position they include
+def replication_snapshot():
+    with catalog.lock:
+        return replication_log.seq, catalog.to_rows()
+
+# One background sender per peer ships the replication log to it, all in parallel: peer URL -> sender
+replica_senders = {}
+
+# A new sender asks the peer how far it got, so a peer that rejoins only gets the writes it
+# missed, and a new one a snapshot. Only the primary makes writes, so only it ships a log.
+def start_replicating(url):
+    if not IS_PRIMARY:
+        return
+    stop_replicating(url)
+    replica_senders[url] = ReplicaSender(replication_log, url, SELF_URL, replication_snapshot)
+
+def stop_replicating(url):
+    sender = replica_senders.pop(url, None)
+    if sender is not None:
+        sender.stop()
+
+# The other catalog servers. CATALOG_PEER_URLS seeds the group; replicas can join
+# and leave at runtime (see common/membership.py), and the frontends are told.
+membership = Membership('catalog', SELF_URL,
+                        url_list('CATALOG_PEER_URLS', 'http://localhost:5000,http://localhost:5003'),
+                        observers=FRONTEND_URLS, on_join=start_replicating, on_leave=stop_replicating)
+add_membership_routes(app, membership)
+
+# Replication progress as metric families for /metrics: this server's log position
+# and, per peer, how many deltas it has not acknowledged yet
+def replication_metrics():
+    seq = replication_log.seq
+    return [
+        ('catalog_replication_seq', 'gauge', 'Last position in this server\'s replication log', [({}, seq)]),
+        ('catalog_replication_lag', 'gauge', 'Deltas a peer has not acknowledged yet',
+         [({'peer': url}, seq - sender.acked) for url, sender in list(replica_senders.items())])
+    ]
+
+collect(replication_metrics)
+
+# Wait for the peers required by REPLICATION_QUORUM to acknowledge the log up to `seq`.
+# A write that misses its quorum in time still succeeds locally and keeps being replicated.
+def wait_for_replicas(seq):
+    senders = list(replica_senders.values())
+    required = required_acks(REPLICATION_QUORUM, len(senders))
+    if required <= 0:
+        return
+    with span('replication quorum wait', required=required) as wait_span:
+        reached = wait_for_quorum(replication_log, senders, seq, required)
+        if wait_span is not None:
+            wait_span.set('reached', reached)
+    if not reached:
+        log.warning('Replication quorum not reached', extra={'quorum': REPLICATION_QUORUM, 'seq': seq})
+
+# Publishes batched cache invalidations to the frontends, off the request path
+invalidations = InvalidationPublisher()
+
+# Invalidate the frontend caches for a book, as of its current version
+def invalidate_frontend_cache(book):
+    invalidations.publish(book.id, book.version)
+
+# Wait up to SESSION_READ_WAIT seconds for this server to apply the book versions in
+# the request's session token (see common/session.py). Returns None once it has, or
+# a 412 response telling the frontend to read from another replica.
+def session_behind():
+    required = parse_token(request.headers.get(SESSION_HEADER))
+    if not required:
+        return None
+    with replicated:
+        if replicated.wait_for(lambda: catalog.has_versions(required), SESSION_READ_WAIT):
+            return None
+    log.info('Behind session', extra={'session': format_token(required)})
+    return jsonify({'error': 'Replica has not caught up with the session'}), 412
+
+# Send the write being handled to the primary (see CATALOG_PRIMARY_URL) and relay its
+# answer, including the session token. Returns None on the primary itself, which
+# makes the write, or a 503 response if the primary cannot be reached. The write is
+# not retried, since it may have been made before the connection failed.
+def forward_to_primary():
+    if IS_PRIMARY:
+        return None
     try:
-        frontend_url = 'http://localhost:5002'  
-        response = requests.post(f'{frontend_url}/invalidate_cache/{item_number}')
-        response.raise_for_status()
-        print(f'Cache invalidated successfully in the frontend server for item {item_number}')
+        response = http_client.request(request.method, f'{CATALOG_PRIMARY_URL}{request.path}',
+                                       params=request.args, data=request.get_data(),
+                                       headers={'Content-Type': request.content_type or 'application/json'},
+                                       retries=0)
     except requests.exceptions.RequestException as e:
-        print(f"Error invalidating cache in the frontend server: {e}")
+        log.warning('Error forwarding write to primary', extra={'url': CATALOG_PRIMARY_URL, 'error': str(e)})
+        return jsonify({'error': f'Primary catalog server unreachable: {e}'}), 503
+    forwarded = Response(response.content, response.status_code, content_type=response.headers.get('Content-Type'))
+    if SESSION_HEADER in response.headers:
+        forwarded.headers[SESSION_HEADER] = response.headers[SESSION_HEADER]
+    return forwarded
+
+# Session token naming the version a write left a book at
+def session_token(book):
+    return format_token({str(book.id): book.version})
+
+# Respond with `payload` tagged with an ETag, or with 304 Not Modified if the
+# request's If-None-Match already names that ETag
+def conditional_json(payload, etag):
+    response = jsonify(payload)
+    response.set_etag(etag)
+    response.headers['X-Catalog-Version'] = str(catalog.version)
+    return response.make_conditional(request)
 
 # Search for items in the catalog based on the provided item name (topic)
 @app.route('/search/<item_name>', methods=['GET'])
 def search_items(item_name):
+    behind = session_behind()
+    if behind is not None:
+        return behind
+
+    # Optional query parameters: fields=topic,title  match=substring|prefix  limit=N  offset=N
+    fields = [field for field in request.args.get('fields', 'topic').split(',') if field in SEARCH_FIELDS]
+    match = request.args.get('match', 'substring')
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(limit, 0)
+
+    # Any change to the catalog may change the results, so they are tagged with the catalog version
+    version = catalog.version
+    books = catalog.search(item_name, fields or ['topic'], match)
+    page = books[offset:] if limit is None else books[offset:offset + limit]
+
     results = []
-    for book_id, book in enumerate(catalog, start=1):
-        if item_name.lower() in book.get('Topic', '').lower():
-            results.append({
-                'id': book['ID'],
-                'title': book['Title']
-            })
-
-    print(f'Replica {replica_server_id} on Port {replica_server_port}: Catalog Search! Item Name: {item_name}')
-    return jsonify(results)
+    for book in page:
+        results.append({
+            'id': book.id,
+            'title': book.title
+        })
+
+    log_sampled(log, 'Catalog search', item_name=item_name)
+    response = conditional_json(results, f'c{version}')
+    response.headers['X-Total-Count'] = str(len(books))
+    return response
+
+# The /info fields of a book
+def info_result(book):
+    return {
+        'title': book.title,
+        'quantity': book.quantity,
+        'price': book.price,
+        'version': book.version
+    }
 
 # Retrieve information about a book based on the provided item number
 @app.route('/info/<item_number>', methods=['GET'])
 def book_info(item_number):
-    for book_id, book in enumerate(catalog, start=1):
-        if str(book_id) == item_number:
-            result = {
-                'title': book['Title'],
-                'quantity': int(book['Quantity']),
-                'price': float(book['Price'])
-            }
-            print(f'Replica {replica_server_id} on Port {replica_server_port}: Catalog Info! Item Number: {item_number}')
-            return jsonify(result)
+    behind = session_behind()
+    if behind is not None:
+        return behind
+
+    book = catalog.get(item_number)
+    if book is not None:
+        # Read under the lock so the ETag matches the values returned
+        with catalog.lock:
+            result = info_result(book)
+        log_sampled(log, 'Catalog info', item_number=item_number)
+        return conditional_json(result, f'{book.id}.{result["version"]}')
 
     return jsonify({'error': 'Book not found'})
 
+# Retrieve information about several books in one call: /info?ids=1,2,3.
+# Returns {item_number: info or {'error': 'Book not found'}}.
+@app.route('/info', methods=['GET'])
+def books_info():
+    behind = session_behind()
+    if behind is not None:
+        return behind
+
+    item_numbers = [item_number for item_number in request.args.get('ids', '').split(',') if item_number]
+    results = {}
+    with catalog.lock:
+        for item_number in item_numbers:
+            book = catalog.get(item_number)
+            results[item_number] = info_result(book) if book is not None else {'error': 'Book not found'}
+    log_sampled(log, 'Catalog info', item_numbers=item_numbers)
+    return jsonify(results)
+
+# An integer from a JSON request body: a JSON integer (not a boolean) or a string holding one.
+# Returns None for anything else, including numbers with a fraction.
+def json_int(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        try:
+            return int(value.strip())
+        except ValueError:
+            return None
+    return None
+
+# A finite number from a JSON request body, or a string holding one; None for anything else
+def json_number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    return number if math.isfinite(number) else None
+
+# Update a book's quantity and/or price: {'quantity', 'price'}. Made on the primary.
+# The quantity must be an integer of at least 0 and the price a number of at least 0;
+# a request with neither, or with an invalid one, is answered 400.
 @app.route('/update/<item_number>', methods=['PUT'])
 def update_book(item_number):
-    for book_id, book in enumerate(catalog, start=1):
-        if str(book_id) == item_number:
-
-            old_quantity = book['Quantity']
-            old_price = book['Price']
-
-            # Update the book details
-            if 'quantity' in request.json:
-                new_quantity = request.json.get('quantity')
-                book['Quantity'] = str(new_quantity)
-            if 'price' in request.json:
-                new_price = request.json.get('price')
-                book['Price'] = str(new_price)
-
-            # Update the CSV file
-            save_catalog()
-
-            # Notify other replicas about the update
-            notify_replicas_update(item_number, old_quantity, old_price)
-            
-            invalidate_frontend_cache(item_number)
-
-            print(f'Replica {replica_server_id} on Port {replica_server_port}: Book updated successfully')
-            return jsonify({'message': 'Book updated successfully'})
+    forwarded = forward_to_primary()
+    if forwarded is not None:
+        return forwarded
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or (data.get('quantity') is None and data.get('price') is None):
+        return jsonify({'error': 'quantity or price is required'}), 400
+    quantity = price = None
+    if data.get('quantity') is not None:
+        quantity = json_int(data['quantity'])
+        if quantity is None or quantity < 0:
+            return jsonify({'error': 'quantity must be an integer of at least 0'}), 400
+    if data.get('price') is not None:
+        price = json_number(data['price'])
+        if price is None or price < 0:
+            return jsonify({'error': 'price must be a number of at least 0'}), 400
+
+    book = catalog.get(item_number)
+    if book is not None:
+        # Update the book details, journal the change and log it for replication
+        book = apply_update(item_number, quantity, price)
+
+        invalidate_frontend_cache(book)
+
+        log_sampled(log, 'Book updated', item_number=item_number)
+        response = jsonify({'message': 'Book updated successfully', 'version': book.version})
+        response.headers[SESSION_HEADER] = session_token(book)
+        return response
 
     return jsonify({'error': 'Book not found'}), 404
 
 
-@app.route('/update_replica/<item_number>', methods=['PUT'])
-def update_replica_book(item_number):
+# Receive deltas from a peer's replication stream:
+# {'source': peer ID, 'epoch': stream epoch, 'from': offset the deltas follow, 'deltas': [...]}.
+# Answers with the offset now applied from that stream, or 409 and the offset this
+# server is at if it has not applied up to 'from', so the peer resends from there.
+# The offset is None if this server does not know the stream; the peer then sends a snapshot.
+@app.route('/replicate', methods=['POST'])
+def replicate():
     data = request.get_json()
-
-    # This is a replica update request
-    for book_id, book in enumerate(catalog, start=1):
-        if str(book_id) == item_number:
-            # Save the current values for reference
-            old_quantity = book['Quantity']
-            old_price = book['Price']
-
-            # Update the book details
-            if 'quantity' in data:
-                new_quantity = data.get('quantity')
-                book['Quantity'] = str(new_quantity)
-            if 'price' in data:
-                new_price = data.get('price')
-                book['Price'] = str(new_price)
-
-            print(f"Replica {replica_server_id} on Port {replica_server_port}: Updated catalog content: {catalog}")
-
-            # Update the CSV file
-            save_catalog()
-
-            # If it's not a notification, notify other replicas
-            if not data.get('is_notification', False):
-                notify_replicas_update(item_number, old_quantity, old_price)
-
-            print(f'Replica {replica_server_id} on Port {replica_server_port}: Book updated successfully (Replica)')
-            return jsonify({'message': 'Book updated successfully (Replica)'})
-
-    return jsonify({'error': 'Book not found'}), 404
-
-
-def notify_replicas_update(item_number, old_quantity, old_price):
-    for port in [5000, 5003]: 
-        if port != replica_server_port:
-            try:
-                data = {'quantity': request.json.get('quantity', old_quantity),
-                        'price': request.json.get('price', old_price)}
-                requests.put(f'http://localhost:{port}/update_replica/{item_number}', json=data, timeout=10)
-            except requests.exceptions.RequestException as e:
-                print(f"Error notifying replica on port {port}: {e}")
+    applied = applied_offsets.get(data['source'], data['epoch'])
+    if applied is None or applied < data['from']:
+        return jsonify({'applied': applied}), 409
+
+    deltas = [delta for delta in data['deltas'] if delta['seq'] > applied]
+    if deltas:
+        applied = deltas[-1]['seq']
+        apply_replicated(deltas, data['source'], data['epoch'], applied)
+
+    log_sampled(log, 'Applied deltas', count=len(deltas), source=data['source'])
+    return jsonify({'applied': applied})
+
+# Receive a full snapshot from a peer whose log no longer holds the deltas this server needs:
+# {'source', 'epoch', 'seq': log position the snapshot includes, 'books': catalog rows}.
+@app.route('/replicate_snapshot', methods=['POST'])
+def replicate_snapshot():
+    data = request.get_json()
+    apply_replicated([vars(Book.from_row(row)) for row in data['books']], data['source'], data['epoch'], data['seq'])
+
+    log.info('Applied snapshot', extra={'seq': data['seq'], 'source': data['source']})
+    return jsonify({'applied': data['seq']})
+
+# Replication progress: this server's log position, the offset each peer has
+# acknowledged and the offset applied from each peer's stream
+@app.route('/replication', methods=['GET'])
+def replication_status():
+    return jsonify({
+        'primary': CATALOG_PRIMARY_URL,
+        'epoch': replication_log.epoch,
+        'seq': replication_log.seq,
+        'peers': {url: sender.acked for url, sender in list(replica_senders.items())},
+        'applied': applied_offsets.to_dict()
+    })
 
 # Retrieve the entire catalog
 @app.route('/catalog', methods=['GET'])
 def get_catalog():
-    return jsonify(catalog)
-
-# Notify about catalog updates and reload catalog data from the CSV file
+    behind = session_behind()
+    if behind is not None:
+        return behind
+
+    with catalog.lock:
+        version = catalog.version
+        rows = catalog.to_rows()
+    return conditional_json(rows, f'c{version}')
+
+# Current catalog-wide version, bumped by every change to any book
+@app.route('/version', methods=['GET'])
+def get_version():
+    return jsonify({'version': catalog.version})
+
+# Liveness check used by the frontends' load balancers
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({'status': 'ok'})
+
+# Changes from other servers arrive through the replication stream, so an update
+# notification no longer reloads the catalog; it reports the replication progress.
 @app.route('/notify', methods=['POST'])
 def notify_update():
     data = request.get_json()
@@ -150,37 +491,99 @@ def notify_update():
     if 'message' in data and data['message'] == 'update':
         item_number = data.get('item_number')
         sender = data.get('sender')
-        print(f'Received update notification for item {item_number} from replica on port {sender}')
-        
-        load_catalog()
-        
-        # Save the updated catalog to the catalog_replica.csv file
-        save_catalog()
-        
-        print(f'Replica {replica_server_id} on Port {replica_server_port}: Catalog updated successfully (Replica) for item {item_number}')
-        return jsonify({'message': 'Catalog updated successfully (Replica)'})
+        log.info('Received update notification', extra={'item_number': item_number, 'sender': sender})
+        return replication_status()
 
     return jsonify({'error': 'Invalid notification'}), 400
 
 # Verify if a book with a given ID is in stock
 @app.route('/verify/<item_id>', methods=['POST'])
 def verify_stock(item_id):
-    for book_id, book in enumerate(catalog, start=1):
-        if str(book_id) == item_id:
-            current_quantity = int(book.get('Quantity', 0))
-
-            if current_quantity > 0:
-                return jsonify({'message': 'Book is in stock'})
-            else:
-                return jsonify({'error': 'Book out of stock'})
+    book = catalog.get(item_id)
+    if book is not None:
+        if book.quantity > 0:
+            return jsonify({'message': 'Book is in stock'})
+        else:
+            return jsonify({'error': 'Book out of stock'})
 
     return jsonify({'error': 'Book not found'}), 404
 
+# Verify several books in one call: {'ids': [item_number, ...]}.
+# Returns {item_number: {'message': ...} or {'error': ...}} with the same answers as /verify/<item_id>.
+@app.route('/verify', methods=['POST'])
+def verify_stock_batch():
+    results = {}
+    for item_id in (request.get_json(silent=True) or {}).get('ids', []):
+        book = catalog.get(item_id)
+        if book is None:
+            results[str(item_id)] = {'error': 'Book not found'}
+        elif book.quantity > 0:
+            results[str(item_id)] = {'message': 'Book is in stock'}
+        else:
+            results[str(item_id)] = {'error': 'Book out of stock'}
+    return jsonify(results)
+
+# Atomically decrement a book's stock in a single call: {'count': N, 'expected_quantity': Q}.
+# Both fields are optional (count defaults to 1); with 'expected_quantity' the decrement only
+# happens if the stock still equals it. Returns the book's title, new quantity and new version,
+# and the session token for it in SESSION_HEADER.
+@app.route('/decrement/<item_number>', methods=['POST'])
+def decrement_book(item_number):
+    forwarded = forward_to_primary()
+    if forwarded is not None:
+        return forwarded
+
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    count = json_int(data.get('count', 1))
+    if count is None or count < 1:
+        return jsonify({'error': 'count must be an integer of at least 1'}), 400
+    expected = data.get('expected_quantity')
+    if expected is not None:
+        expected = json_int(expected)
+        if expected is None or expected < 0:
+            return jsonify({'error': 'expected_quantity must be an integer of at least 0'}), 400
+    book, error = apply_decrement(item_number, count, expected)
+
+    if error == 'Book not found':
+        return jsonify({'error': error}), 404
+    if error is not None:
+        return jsonify({'error': error, 'quantity': book.quantity}), 409
+
+    invalidate_frontend_cache(book)
+
+    log_sampled(log, 'Stock decremented', item_number=item_number)
+    response = jsonify({'id': book.id, 'title': book.title, 'quantity': book.quantity, 'version': book.version})
+    response.headers[SESSION_HEADER] = session_token(book)
+    return response
+
+# Decrement stock for a batch of purchases: {'items': {item_number: count}}.
+# Each book gives out as many units as it has in stock; the response maps each
+# item number to the units granted, the new quantity, the title and the new version.
+@app.route('/decrement_batch', methods=['POST'])
+def decrement_batch():
+    forwarded = forward_to_primary()
+    if forwarded is not None:
+        return forwarded
+
+    counts = request.get_json().get('items', {})
+    results = apply_decrements(counts)
+
+    for item_number, result in results.items():
+        if result.get('granted'):
+            book = catalog.get(item_number)
+            invalidate_frontend_cache(book)
+
+    log_sampled(log, 'Stock decremented', item_numbers=list(results))
+    return jsonify(results)
+
 def run_app(port):
-    app.run(host='0.0.0.0', port=port, debug=True)
+    serve(app, port)
 
 if __name__ == '__main__':
-    replica_server_id = 1
-    replica_server_port = 5000  
-    print(f'Replica {replica_server_id} on Port {replica_server_port}: Catalog Server Running on Port {replica_server_port}')
-    app.run(host='0.0.0.0', port=replica_server_port, debug=True)
+    log.info('Catalog server running', extra={'port': replica_server_port})
+    membership.announce()
+    serve(app, replica_server_port)
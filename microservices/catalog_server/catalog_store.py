@@ -0,0 +1,277 @@
+import csv
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from dataclasses import dataclass
+from common.journal import atomic_write
+
+FIELDNAMES = ['ID', 'Title', 'Quantity', 'Price', 'Topic', 'Version']
+
+# Text fields covered by the search index
+SEARCH_FIELDS = ('topic', 'title')
+
+# Longest n-gram kept in the index; longer queries intersect their n-grams
+MAX_GRAM = 3
+
+
+# A single catalog record, with quantity and price held as native numbers.
+# `version` is bumped on every change, so readers can tell which copy is newer.
+@dataclass
+class Book:
+    id: int
+    title: str
+    quantity: int
+    price: float
+    topic: str
+    version: int = 0
+
+    # Build a record from a CSV row, parsing the numeric columns once
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            id=int(row['ID']),
+            title=row['Title'],
+            quantity=int(row['Quantity']),
+            price=float(row['Price']),
+            topic=row.get('Topic', ''),
+            version=int(row.get('Version') or 0)
+        )
+
+    # Same keys as the CSV header, so '/catalog' keeps its shape
+    def to_row(self):
+        return {
+            'ID': self.id,
+            'Title': self.title,
+            'Quantity': self.quantity,
+            'Price': self.price,
+            'Topic': self.topic,
+            'Version': self.version
+        }
+
+
+# Parse an item number coming from a URL; returns None if it is not an integer
+def parse_id(item_number):
+    try:
+        return int(item_number)
+    except (TypeError, ValueError):
+        return None
+
+
+# Split a lower-cased text value into its n-grams (1 to MAX_GRAM characters)
+def ngrams(text):
+    grams = set()
+    for n in range(1, MAX_GRAM + 1):
+        for i in range(len(text) - n + 1):
+            grams.add(text[i:i + n])
+    return grams
+
+
+# The n-grams a substring query has to match, all of the longest size available
+def query_grams(query):
+    n = min(len(query), MAX_GRAM)
+    return {query[i:i + n] for i in range(len(query) - n + 1)}
+
+
+# In-memory catalog with an ID hash index and an inverted index over Topic and Title.
+# `version` is the catalog-wide version: the sum of all book versions, so it grows
+# with every change and is the same on replicas that have applied the same changes.
+class CatalogStore:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._books = {}
+        self.version = 0
+        self._reset_index()
+
+    def _reset_index(self):
+        # field -> n-gram -> set of book IDs, used for substring queries
+        self._grams = {field: defaultdict(set) for field in SEARCH_FIELDS}
+        # field -> word -> set of book IDs, used for prefix queries
+        self._words = {field: defaultdict(set) for field in SEARCH_FIELDS}
+        # field -> sorted list of indexed words, for prefix range scans
+        self._sorted_words = {field: [] for field in SEARCH_FIELDS}
+
+    def _index(self, book):
+        for field in SEARCH_FIELDS:
+            value = getattr(book, field).lower()
+            for gram in ngrams(value):
+                self._grams[field][gram].add(book.id)
+            for word in value.split():
+                if word not in self._words[field]:
+                    sorted_words = self._sorted_words[field]
+                    sorted_words.insert(bisect_left(sorted_words, word), word)
+                self._words[field][word].add(book.id)
+
+    def _unindex(self, book):
+        for field in SEARCH_FIELDS:
+            value = getattr(book, field).lower()
+            for gram in ngrams(value):
+                postings = self._grams[field][gram]
+                postings.discard(book.id)
+                if not postings:
+                    del self._grams[field][gram]
+            for word in value.split():
+                postings = self._words[field][word]
+                postings.discard(book.id)
+                if not postings:
+                    del self._words[field][word]
+                    sorted_words = self._sorted_words[field]
+                    del sorted_words[bisect_left(sorted_words, word)]
+
+    def __len__(self):
+        return len(self._books)
+
+    # Replace the store contents with the rows of the given CSV file
+    def load(self, filename):
+        with open(filename, 'r') as csvfile:
+            books = [Book.from_row(row) for row in csv.DictReader(csvfile)]
+        with self.lock:
+            self._books = {book.id: book for book in books}
+            self.version = sum(book.version for book in books)
+            self._reset_index()
+            for book in books:
+                self._index(book)
+
+    # Write the store contents back to the given CSV file (atomically)
+    def save(self, filename):
+        with self.lock:
+            rows = self.to_rows()
+
+        def write(csvfile):
+            writer = csv.DictWriter(csvfile, fieldnames=FIELDNAMES)
+            writer.writeheader()
+            writer.writerows(rows)
+
+        atomic_write(filename, write)
+
+    # O(1) lookup by item number (int or the string taken from the URL)
+    def get(self, item_number):
+        book_id = item_number if isinstance(item_number, int) else parse_id(item_number)
+        return self._books.get(book_id)
+
+    def books(self):
+        with self.lock:
+            return list(self._books.values())
+
+    def to_rows(self):
+        return [book.to_row() for book in self.books()]
+
+    # Whether every book in `versions` ({item_number: version}) is at least at that version.
+    # Unknown books count as caught up, since no read can return them anyway.
+    def has_versions(self, versions):
+        with self.lock:
+            for item_number, version in versions.items():
+                book = self.get(item_number)
+                if book is not None and book.version < version:
+                    return False
+            return True
+
+    # Apply a change to a book; returns the updated book or None.
+    # Title and topic changes are re-indexed in place.
+    # Without `version` the book's version is bumped by one. A change carrying the
+    # version it was made at (replication, journal replay) is only applied if it is
+    # newer than the book, so late or repeated deliveries cannot roll it back.
+    def update(self, item_number, quantity=None, price=None, title=None, topic=None, version=None):
+        with self.lock:
+            book = self.get(item_number)
+            if book is None:
+                return None
+            if version is None:
+                version = book.version + 1
+            elif int(version) <= book.version:
+                return book
+            self.version += int(version) - book.version
+            book.version = int(version)
+            if quantity is not None:
+                book.quantity = int(quantity)
+            if price is not None:
+                book.price = float(price)
+            if (title is not None and title != book.title) or (topic is not None and topic != book.topic):
+                self._unindex(book)
+                if title is not None:
+                    book.title = title
+                if topic is not None:
+                    book.topic = topic
+                self._index(book)
+            return book
+
+    # Atomically take `count` units of a book's stock. With `expected` set this is a
+    # compare-and-set: the stock is only taken if the quantity still equals `expected`.
+    # Returns (book, error) where error is None, 'Book not found', 'Book out of stock'
+    # or 'Quantity changed'.
+    def decrement(self, item_number, count=1, expected=None):
+        with self.lock:
+            book = self.get(item_number)
+            if book is None:
+                return None, 'Book not found'
+            if expected is not None and book.quantity != int(expected):
+                return book, 'Quantity changed'
+            if count < 1 or book.quantity < count:
+                return book, 'Book out of stock'
+            book.quantity -= count
+            book.version += 1
+            self.version += 1
+            return book, None
+
+    # Take up to `count` units of stock for each book in `counts` ({item_number: count}).
+    # Returns {item_number: {'granted': units taken, 'quantity': new quantity, 'title': title,
+    # 'version': new version}},
+    # with {'error': 'Book not found'} for unknown books.
+    def decrement_many(self, counts):
+        results = {}
+        with self.lock:
+            for item_number, count in counts.items():
+                book = self.get(item_number)
+                if book is None:
+                    results[item_number] = {'error': 'Book not found'}
+                    continue
+                granted = max(min(int(count), book.quantity), 0)
+                if granted:
+                    self.decrement(item_number, granted, expected=book.quantity)
+                results[item_number] = {'granted': granted, 'quantity': book.quantity, 'title': book.title,
+                                        'version': book.version}
+        return results
+
+    # Books whose fields contain the query (match='substring') or have a word
+    # starting with it (match='prefix'), ordered by ID.
+    # Only the postings of the query's n-grams or words are visited.
+    def search(self, query, fields=('topic',), match='substring'):
+        query = query.lower()
+        with self.lock:
+            matches = set()
+            for field in fields:
+                if match == 'prefix':
+                    matches |= self._prefix_candidates(field, query)
+                else:
+                    matches |= self._substring_candidates(field, query)
+            return [self._books[book_id] for book_id in sorted(matches)]
+
+    def _substring_candidates(self, field, query):
+        if not query:
+            return set(self._books)
+        candidates = None
+        for gram in query_grams(query):
+            postings = self._grams[field].get(gram)
+            if not postings:
+                return set()
+            candidates = set(postings) if candidates is None else candidates & postings
+        # n-gram hits are only candidates once the query is longer than MAX_GRAM
+        if len(query) > MAX_GRAM:
+            candidates = {book_id for book_id in candidates
+                          if query in getattr(self._books[book_id], field).lower()}
+        return candidates
+
+    def _prefix_candidates(self, field, query):
+        words = query.split()
+        if not words:
+            return set(self._books)
+        sorted_words = self._sorted_words[field]
+        candidates = set()
+        i = bisect_left(sorted_words, words[0])
+        while i < len(sorted_words) and sorted_words[i].startswith(words[0]):
+            candidates |= self._words[field][sorted_words[i]]
+            i += 1
+        # multi-word queries must still match at a word boundary
+        if len(words) > 1:
+            candidates = {book_id for book_id in candidates
+                          if (' ' + getattr(self._books[book_id], field).lower()).find(' ' + query) != -1}
+        return candidates
@@ -0,0 +1,217 @@
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+from common import http_client
+from common.journal import atomic_write
+
+log = logging.getLogger(__name__)
+
+# Number of deltas kept to catch peers up; a peer that is further behind gets a snapshot
+REPLICATION_LOG_SIZE = int(os.environ.get('REPLICATION_LOG_SIZE', '10000'))
+
+# Largest number of deltas shipped to a peer in one request
+REPLICATION_BATCH_SIZE = int(os.environ.get('REPLICATION_BATCH_SIZE', '500'))
+
+# Seconds to wait before retrying a peer that could not be reached
+REPLICATION_RETRY_INTERVAL = float(os.environ.get('REPLICATION_RETRY_INTERVAL', '1.0'))
+
+# Peer acknowledgements a write waits for: 'all', 'majority' or 'async' (none)
+REPLICATION_QUORUM = os.environ.get('REPLICATION_QUORUM', 'async')
+
+# Longest a write waits for its quorum; lagging peers keep being retried afterwards
+REPLICATION_QUORUM_TIMEOUT = float(os.environ.get('REPLICATION_QUORUM_TIMEOUT', '1.0'))
+
+
+# The delta shipped for a changed book: its full new state, so applying a delta
+# twice, or after a newer one, changes nothing (see CatalogStore.update)
+def delta(book):
+    return {'id': book.id, 'quantity': book.quantity, 'price': book.price, 'version': book.version}
+
+
+# Sequenced log of the changes made on this server (not the ones replicated to it).
+#
+# Deltas are numbered 1, 2, 3, ... within an `epoch`, a random ID that changes
+# every time the server starts, so peers can tell a restarted stream from a gap.
+# Only the last `max_entries` deltas are kept in memory.
+class ReplicationLog:
+    def __init__(self, max_entries=REPLICATION_LOG_SIZE):
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self._deltas = deque(maxlen=max_entries)
+        self.changed = threading.Condition()
+        # Notified whenever a peer acknowledges more of the log
+        self.acknowledged = threading.Condition()
+
+    # Append a delta per changed book; returns the sequence number of the last one
+    def append(self, books):
+        with self.changed:
+            for book in books:
+                self.seq += 1
+                self._deltas.append(dict(delta(book), seq=self.seq))
+            self.changed.notify_all()
+            return self.seq
+
+    # Up to `limit` deltas following `offset`, or None if some of them were already dropped
+    def since(self, offset, limit=REPLICATION_BATCH_SIZE):
+        with self.changed:
+            first = self.seq - len(self._deltas) + 1
+            if offset + 1 < first:
+                return None
+            start = offset + 1 - first
+            return list(itertools.islice(self._deltas, start, start + limit))
+
+
+# Ships a ReplicationLog to one peer from a background thread; every peer has
+# its own sender, so a slow peer never holds up the others.
+#
+# `acked` is the last sequence number the peer confirmed, and the deltas after it
+# are sent in batches to the peer's POST /replicate, which answers with the offset
+# it has applied. A new sender first asks the peer for its position with an empty
+# batch; a peer that restarted keeps its offsets (see AppliedOffsets) and answers
+# with them, so it only gets the deltas it missed. If the peer has a different
+# position in the stream it answers 409 with it, and shipping resumes from there.
+#
+# The log only holds the changes made since this server started, so a peer that
+# does not know the current epoch at all (this server restarted, or the peer is
+# new) is sent `snapshot()` at POST /replicate_snapshot instead, and so is a peer
+# whose deltas are no longer in the log. `snapshot()` must return (seq, rows), the
+# log position and catalog rows read together.
+class ReplicaSender:
+    def __init__(self, log, peer_url, source, snapshot):
+        self.log = log
+        self.peer_url = peer_url
+        self.source = source
+        self.snapshot = snapshot
+        self.acked = 0
+        # Whether the peer has confirmed its position in the current epoch
+        self.synced = False
+        self.stopped = False
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    # Stop shipping, e.g. because the peer left the group
+    def stop(self):
+        with self.log.changed:
+            self.stopped = True
+            self.log.changed.notify_all()
+
+    def _run(self):
+        while True:
+            with self.log.changed:
+                self.log.changed.wait_for(lambda: self.stopped or not self.synced or self.log.seq > self.acked)
+                if self.stopped:
+                    return
+            # Any failure, including a malformed reply, is retried; the sender must not die
+            try:
+                self._ship()
+            except Exception as e:
+                log.warning('Error replicating', extra={'peer': self.peer_url, 'error': f'{type(e).__name__}: {e}'})
+                time.sleep(REPLICATION_RETRY_INTERVAL)
+
+    def _ship(self):
+        # Until the peer has confirmed its position, send no deltas, only ask for it
+        deltas = self.log.since(self.acked) if self.synced else []
+        if deltas is None:
+            self._ship_snapshot()
+            return
+        data = {'source': self.source, 'epoch': self.log.epoch, 'from': self.acked, 'deltas': deltas}
+        response = http_client.post(f'{self.peer_url}/replicate', json=data)
+        if response.status_code == 409:
+            # The peer has a different position in this stream: resume from there, or from a
+            # snapshot if it does not know this stream at all
+            applied = response.json().get('applied')
+            if applied is None:
+                self._ship_snapshot()
+                return
+            self._ack(applied)
+            self.synced = True
+            return
+        response.raise_for_status()
+        self._ack(response.json()['applied'])
+        self.synced = True
+
+    def _ship_snapshot(self):
+        seq, rows = self.snapshot()
+        log.info('Sending a snapshot', extra={'peer': self.peer_url, 'acked': self.acked, 'seq': seq})
+        data = {'source': self.source, 'epoch': self.log.epoch, 'seq': seq, 'books': rows}
+        response = http_client.post(f'{self.peer_url}/replicate_snapshot', json=data)
+        response.raise_for_status()
+        self._ack(response.json()['applied'])
+        self.synced = True
+
+    def _ack(self, seq):
+        with self.log.acknowledged:
+            self.acked = seq
+            self.log.acknowledged.notify_all()
+
+
+# Number of peer acknowledgements a write needs under `quorum`: every peer for
+# 'all', a majority of the servers counting this one for 'majority', none for 'async'
+def required_acks(quorum, peers):
+    if quorum == 'all':
+        return peers
+    if quorum == 'majority':
+        return (peers + 1) // 2
+    return 0
+
+
+# Block until `required` of the senders have acknowledged `log` up to `seq`, or
+# until `timeout` seconds have passed. Returns whether the quorum was reached.
+def wait_for_quorum(log, senders, seq, required, timeout=REPLICATION_QUORUM_TIMEOUT):
+    if required <= 0:
+        return True
+    with log.acknowledged:
+        return log.acknowledged.wait_for(lambda: sum(sender.acked >= seq for sender in senders) >= required,
+                                         timeout)
+
+
+# Position reached in the replication stream received from each peer: source -> (epoch, seq).
+# The server journals every offset it sets, together with the changes it applied up
+# to it, and saves them all with its snapshots, so it still knows them after a restart.
+class AppliedOffsets:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._offsets = {}
+
+    # Last sequence number applied from `source` in `epoch`, or None if that stream is unknown
+    def get(self, source, epoch):
+        with self.lock:
+            known_epoch, seq = self._offsets.get(source, (None, None))
+            return seq if known_epoch == epoch else None
+
+    def set(self, source, epoch, seq):
+        with self.lock:
+            self._offsets[source] = (epoch, seq)
+
+    def to_dict(self):
+        with self.lock:
+            return {source: {'epoch': epoch, 'applied': seq} for source, (epoch, seq) in self._offsets.items()}
+
+    # Journal records holding the offsets: {'source', 'epoch', 'applied'}
+    def to_records(self):
+        with self.lock:
+            return [offset_record(source, epoch, seq) for source, (epoch, seq) in self._offsets.items()]
+
+    # Write the offsets to a JSON file (atomically)
+    def save(self, filename):
+        records = self.to_records()
+        atomic_write(filename, lambda offsets_file: json.dump(records, offsets_file))
+
+    # Read the offsets saved by save(); a missing file holds none
+    def load(self, filename):
+        if not os.path.exists(filename):
+            return
+        with open(filename, 'r') as offsets_file:
+            for record in json.load(offsets_file):
+                self.set(record['source'], record['epoch'], record['applied'])
+
+
+# Journal record of the offset applied from `source`'s stream in `epoch`
+def offset_record(source, epoch, seq):
+    return {'source': source, 'epoch': epoch, 'applied': seq}
@@ -0,0 +1,6 @@
+import os
+
+
+# Comma-separated list of URLs from the environment variable `name`, without trailing slashes
+def url_list(name, default=''):
+    return [url.strip().rstrip('/') for url in os.environ.get(name, default).split(',') if url.strip()]
@@ -0,0 +1,126 @@
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common import tracing
+from common.metrics import UPSTREAM_DURATION, UPSTREAM_IN_FLIGHT, outcome
+from common.resilience import (DEADLINE_HEADER, CircuitOpenError, DeadlineExceeded, breaker_for,
+                               remaining, retry_budget)
+
+# Connections kept alive per upstream (scheme + host + port)
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '20'))
+
+# Default (connect, read) timeouts in seconds for calls that do not pass their own
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '1.0'))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '10.0'))
+
+# Retries of an idempotent call that got no answer or a 5xx answer, and the base of their
+# exponential backoff in seconds (each wait is drawn at random up to the backoff)
+RETRIES = int(os.environ.get('HTTP_RETRIES', '2'))
+RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', '0.05'))
+
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def upstream_of(url):
+    parts = urlsplit(url)
+    return f'{parts.scheme}://{parts.netloc}'
+
+
+# Return the keep-alive session for the upstream that serves `url`, creating it on first use
+def session_for(url):
+    upstream = upstream_of(url)
+    session = _sessions.get(upstream)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(upstream)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _sessions[upstream] = session
+    return session
+
+
+# Send a request over the pooled session of its upstream; same arguments as requests.request().
+#
+# The call goes through the upstream's circuit breaker and is cut short at the
+# deadline of the request being handled (see common/resilience.py). Idempotent
+# calls are retried up to `retries` times (default RETRIES, none for other
+# methods) with jittered backoff, while the process-wide retry budget lasts.
+def request(method, url, retries=None, **kwargs):
+    if retries is None:
+        retries = RETRIES if method.upper() in IDEMPOTENT_METHODS else 0
+    retry_budget.deposit()
+    attempt = 0
+    while True:
+        try:
+            response = _send(method, url, **kwargs)
+            if response.status_code < 500 or attempt >= retries or not retry_budget.withdraw():
+                return response
+        except (CircuitOpenError, DeadlineExceeded):
+            raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt >= retries or not retry_budget.withdraw():
+                raise
+        attempt += 1
+        time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+
+
+def _send(method, url, **kwargs):
+    timeout = kwargs.pop('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    if not isinstance(timeout, tuple):
+        timeout = (timeout, timeout)
+    left = remaining()
+    if left is not None:
+        if left <= 0:
+            raise DeadlineExceeded(f'Deadline exceeded before calling {url}')
+        timeout = (min(timeout[0], left), min(timeout[1], left))
+        kwargs['headers'] = dict(kwargs.get('headers') or {}, **{DEADLINE_HEADER: f'{left:.3f}'})
+
+    upstream = upstream_of(url)
+    breaker = breaker_for(upstream)
+    if not breaker.allow():
+        raise CircuitOpenError(f'Circuit to {breaker.upstream} is open')
+    UPSTREAM_IN_FLIGHT.inc(upstream=upstream)
+    start = time.perf_counter()
+    try:
+        # A client span of the current trace; the next server continues the trace from it
+        with tracing.span(f'{method.upper()} {urlsplit(url).path}', upstream=upstream) as client_span:
+            if client_span is not None:
+                kwargs['headers'] = tracing.inject(kwargs.get('headers'))
+            response = session_for(url).request(method, url, timeout=timeout, **kwargs)
+            if client_span is not None:
+                client_span.set('status', response.status_code)
+    except requests.exceptions.RequestException:
+        breaker.record(False)
+        UPSTREAM_DURATION.observe(time.perf_counter() - start, upstream=upstream, method=method.upper(),
+                                  outcome=outcome())
+        raise
+    finally:
+        UPSTREAM_IN_FLIGHT.dec(upstream=upstream)
+    breaker.record(response.status_code < 500)
+    UPSTREAM_DURATION.observe(time.perf_counter() - start, upstream=upstream, method=method.upper(),
+                              outcome=outcome(response.status_code))
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
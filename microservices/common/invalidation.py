@@ -0,0 +1,67 @@
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from common import http_client
+from common.config import url_list
+
+log = logging.getLogger(__name__)
+
+# Frontend instances whose caches must be invalidated, comma-separated
+FRONTEND_URLS = url_list('FRONTEND_URLS', 'http://localhost:5002')
+
+# Seconds to collect invalidations before sending them as one batch
+INVALIDATION_FLUSH_INTERVAL = float(os.environ.get('INVALIDATION_FLUSH_INTERVAL', '0.005'))
+
+
+# Asynchronous, batched cache invalidation for the frontends.
+#
+# publish() only records the item number and the version of the book it was
+# changed to, so writes never wait on a frontend. A background thread wakes up
+# after `flush_interval` seconds, coalesces everything published since the last
+# flush (keeping the highest version per item) and POSTs it to every frontend as
+# {'items': {item_number: version}}. A frontend that is down misses the batch;
+# the next change to the same item (or the cache TTL) catches it up.
+class InvalidationPublisher:
+    def __init__(self, frontend_urls=None, flush_interval=INVALIDATION_FLUSH_INTERVAL):
+        self.frontend_urls = FRONTEND_URLS if frontend_urls is None else frontend_urls
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # item number (str) -> highest version published since the last flush
+        self._pending = {}
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    # Queue an invalidation; returns at once
+    def publish(self, item_number, version):
+        key = str(item_number)
+        with self.lock:
+            if version > self._pending.get(key, -1):
+                self._pending[key] = version
+        self.wakeup.set()
+
+    # Send everything queued so far; returns the batch that was sent
+    def flush(self):
+        with self.lock:
+            batch, self._pending = self._pending, {}
+        if batch:
+            for url in self.frontend_urls:
+                try:
+                    response = http_client.post(f'{url}/invalidate_cache', json={'items': batch})
+                    response.raise_for_status()
+                except requests.exceptions.RequestException as e:
+                    log.warning('Error invalidating frontend cache', extra={'url': url, 'error': str(e)})
+        return batch
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            # Let more invalidations pile up, then send them together
+            self.wakeup.clear()
+            if self.flush_interval > 0:
+                time.sleep(self.flush_interval)
+            self.flush()
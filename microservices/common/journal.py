@@ -0,0 +1,122 @@
+import json
+import os
+import threading
+import time
+
+from common import tracing
+from common.metrics import histogram
+
+FSYNC_DURATION = histogram('journal_fsync_duration_seconds', 'Time to fsync a journal group commit', ('journal',))
+COMPACTION_DURATION = histogram('journal_compaction_duration_seconds',
+                                'Time to write a snapshot and empty its journal', ('journal',))
+
+
+# Append-only JSON-lines journal with group-committed fsyncs.
+#
+# Writers append records under a lock and (optionally) wait until a background
+# flusher has fsynced them. The flusher waits `fsync_interval` seconds after the
+# first pending record so that concurrent writers share one fsync.
+class Journal:
+    def __init__(self, filename, fsync_interval=0.005, compact_every=1000):
+        self.filename = filename
+        self.name = os.path.basename(filename)
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)
+        self.appended_seq = 0
+        self.synced_seq = 0
+        self.records_since_compaction = 0
+        self.file = open(filename, 'a', encoding='utf-8')
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    # Yield the records currently in the journal, oldest first.
+    # A torn last line (crash in the middle of a write) is ignored.
+    def replay(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'r', encoding='utf-8') as journal_file:
+            for line in journal_file:
+                if not line.endswith('\n'):
+                    break
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    break
+
+    def append(self, record, durable=True):
+        return self.append_many([record], durable)
+
+    # Append records in one write; with durable=True, block until they are fsynced.
+    # Returns a sequence number that can be passed to wait_durable() later.
+    def append_many(self, records, durable=True):
+        data = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+        with self.lock:
+            self.file.write(data)
+            self.appended_seq += 1
+            self.records_since_compaction += len(records)
+            seq = self.appended_seq
+            self.synced.notify_all()
+        if durable:
+            self.wait_durable(seq)
+        return seq
+
+    # Block until the append that returned `seq` has been fsynced
+    def wait_durable(self, seq):
+        with self.lock:
+            if self.synced_seq >= seq:
+                return
+            with tracing.span('journal fsync wait', journal=self.name):
+                while self.synced_seq < seq:
+                    self.synced.wait()
+
+    # True once enough records have been written since the last snapshot
+    def needs_compaction(self):
+        return self.records_since_compaction >= self.compact_every
+
+    # Write a snapshot with `write_snapshot()` and then empty the journal.
+    # The caller must stop new appends (e.g. hold its store lock) while this runs.
+    def compact(self, write_snapshot):
+        with self.lock, COMPACTION_DURATION.time(journal=self.name), \
+                tracing.span('journal compaction', journal=self.name):
+            self._sync()
+            write_snapshot()
+            self.file.truncate(0)
+            self.file.seek(0)
+            os.fsync(self.file.fileno())
+            self.records_since_compaction = 0
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.synced_seq = self.appended_seq
+        self.synced.notify_all()
+
+    def _flush_loop(self):
+        while True:
+            with self.lock:
+                while self.synced_seq == self.appended_seq:
+                    self.synced.wait()
+            # Let concurrent writers join this group commit
+            time.sleep(self.fsync_interval)
+            with self.lock:
+                self.file.flush()
+                seq = self.appended_seq
+                fd = self.file.fileno()
+            # fsync outside the lock so new records can be written meanwhile
+            with FSYNC_DURATION.time(journal=self.name):
+                os.fsync(fd)
+            with self.lock:
+                self.synced_seq = max(self.synced_seq, seq)
+                self.synced.notify_all()
+
+
+# Write a file atomically: write a temporary file, fsync it and rename it over the target
+def atomic_write(filename, write):
+    tmp_filename = f'{filename}.tmp'
+    with open(tmp_filename, 'w', newline='') as tmp_file:
+        write(tmp_file)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_filename, filename)
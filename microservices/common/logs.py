@@ -0,0 +1,187 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from common import tracing
+from common.metrics import counter
+
+# Lowest level written: DEBUG, INFO, WARNING, ERROR
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# 'json' writes one JSON object per line; 'text' writes readable lines with key=value fields
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+
+# Records waiting to be written; records beyond this are dropped, never waited for
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+
+# Fraction of per-request log lines written (1 = all, 0 = none); the metrics count every request
+REQUEST_LOG_SAMPLE_RATE = float(os.environ.get('REQUEST_LOG_SAMPLE_RATE', '0.01'))
+
+# Per-route overrides of REQUEST_LOG_SAMPLE_RATE, e.g. '/purchase/<item_number>=1,/search/<item_name>=0.001'
+LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', '')
+
+# Route of the request being handled, as registered (e.g. '/info/<item_number>')
+current_route = contextvars.ContextVar('log_route', default=None)
+
+LOG_RECORDS_DROPPED = counter('log_records_dropped_total', 'Log records dropped because the log queue was full')
+
+# Attributes every LogRecord has; any others were passed in `extra` and are the record's fields
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime', 'taskName', 'service', 'route', 'trace_id'}
+
+
+# Parse LOG_SAMPLE_RATES into {route: rate}; malformed entries are ignored
+def parse_sample_rates(value):
+    rates = {}
+    for part in value.split(','):
+        route, _, rate = part.strip().rpartition('=')
+        try:
+            rates[route] = float(rate)
+        except ValueError:
+            continue
+    rates.pop('', None)
+    return rates
+
+
+sample_rates = parse_sample_rates(LOG_SAMPLE_RATES)
+
+
+# Whether to write a per-request log line, at the sample rate of the current route
+def sampled():
+    rate = sample_rates.get(current_route.get(), REQUEST_LOG_SAMPLE_RATE)
+    return rate >= 1 or random.random() < rate
+
+
+# Log `message` at INFO for a sampled fraction of the requests (see sampled()), with
+# `fields` as the record's structured fields
+def log_sampled(logger, message, **fields):
+    if sampled() and logger.isEnabledFor(logging.INFO):
+        logger.info(message, extra=fields)
+
+
+# Stamps each record with the service, route and trace it was logged in. Runs in the
+# thread that logs, before the record is queued, while those are still known.
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.service = tracing.service_name
+        record.route = current_route.get()
+        active = tracing.current_span()
+        record.trace_id = active.trace_id if active is not None else None
+        return True
+
+
+def _fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 6),
+            'level': record.levelname,
+            'service': getattr(record, 'service', None),
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key in ('route', 'trace_id'):
+            if getattr(record, key, None) is not None:
+                entry[key] = getattr(record, key)
+        entry.update(_fields(record))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str, separators=(',', ':'))
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        fields = _fields(record)
+        for key in ('route', 'trace_id'):
+            if getattr(record, key, None) is not None:
+                fields[key] = getattr(record, key)
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.created))
+        line = f'{stamp}.{int(record.msecs):03d} {record.levelname} {getattr(record, "service", record.name)} ' \
+               f'{record.getMessage()}'
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line += '\n' + record.exc_text
+        return line
+
+
+# Queues records for the writer thread without ever blocking; when the queue is
+# full the record is dropped and counted in LOG_RECORDS_DROPPED.
+class NonBlockingQueueHandler(QueueHandler):
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+    # Keep the record's fields and exception for the formatter on the writer thread;
+    # only the message is rendered here, so its arguments are not shared across threads
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# Writes the queued records to stdout on its own thread
+class LogWriter(QueueListener):
+    # Wait for room for the stop marker, so the records queued before it are all written
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+_writer = None
+
+
+# Send every log record of this process through a queue to a writer thread, so
+# request threads (and the event loop) never wait for stdout. Records are
+# formatted as LOG_FORMAT, stamped with `service` (also the name traces use), the
+# route and the trace they were logged in. Safe to call more than once.
+def setup_logging(service=None):
+    global _writer
+    if service is not None:
+        tracing.service_name = service
+    if _writer is not None:
+        return
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(TextFormatter() if LOG_FORMAT == 'text' else JsonFormatter())
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    _writer = LogWriter(handler.queue, stream)
+    _writer.start()
+    atexit.register(_writer.stop)
+
+
+# Set the route of every request a Flask app handles for the log records (and
+# per-route sampling) of that request
+def log_routes(app):
+    from flask import g, request
+
+    @app.before_request
+    def set_route():
+        g.log_route_token = current_route.set(request.url_rule.rule if request.url_rule is not None else None)
+
+    @app.teardown_request
+    def reset_route(exception):
+        token = g.pop('log_route_token', None)
+        if token is not None:
+            current_route.reset(token)
@@ -0,0 +1,142 @@
+import atexit
+import logging
+import threading
+
+import requests
+
+from common import http_client
+
+log = logging.getLogger(__name__)
+
+
+# Membership of a group of replicated servers (the catalog or the order servers).
+#
+# The group starts from the statically configured peers and changes at runtime.
+# A starting server announces itself to those peers and adopts the members they
+# report, so a new replica only needs one live seed. Whoever receives a join or
+# leave forwards it once to the other members, so the whole group hears about it.
+# `observers` (the frontends) are told about joins and leaves of this server too,
+# so they can route requests to it. `on_join(url)` and `on_leave(url)` run for
+# every peer added or removed, including the configured ones.
+class Membership:
+    def __init__(self, service, self_url, peers=(), observers=(), on_join=None, on_leave=None):
+        self.service = service
+        self.self_url = self_url
+        self.observers = list(observers)
+        self.on_join = on_join
+        self.on_leave = on_leave
+        self.lock = threading.Lock()
+        self._peers = []
+        for url in peers:
+            self.join(url)
+
+    # Current peers, not including this server
+    def peers(self):
+        return list(self._peers)
+
+    def members(self):
+        return ([self.self_url] if self.self_url else []) + self.peers()
+
+    # Add a peer; returns False if it was already a member (or is this server)
+    def join(self, url):
+        url = url.rstrip('/')
+        with self.lock:
+            if url == self.self_url or url in self._peers:
+                return False
+            self._peers = self._peers + [url]
+            if self.on_join is not None:
+                self.on_join(url)
+        log.info('Member joined', extra={'group': self.service, 'url': url})
+        return True
+
+    # Remove a peer; returns False if it was not a member
+    def leave(self, url):
+        url = url.rstrip('/')
+        with self.lock:
+            if url not in self._peers:
+                return False
+            self._peers = [peer for peer in self._peers if peer != url]
+            if self.on_leave is not None:
+                self.on_leave(url)
+        log.info('Member left', extra={'group': self.service, 'url': url})
+        return True
+
+    # Tell the other members that `url` joined or left
+    def forward(self, action, url):
+        for peer in self.peers():
+            if peer != url:
+                self._post(f'{peer}/members/{action}', {'url': url, 'forward': False})
+
+    # Announce this server to the group and the observers from a background thread,
+    # and leave the group again when the process exits
+    def announce(self):
+        threading.Thread(target=self._announce, daemon=True).start()
+        atexit.register(self.withdraw)
+
+    def _announce(self):
+        for peer in self.peers():
+            response = self._post(f'{peer}/members/join', {'url': self.self_url, 'forward': True})
+            if response is not None:
+                for url in response.json().get('members', []):
+                    self.join(url)
+        for observer in self.observers:
+            self._post(f'{observer}/members/{self.service}/join', {'url': self.self_url})
+
+    def withdraw(self):
+        for peer in self.peers():
+            self._post(f'{peer}/members/leave', {'url': self.self_url, 'forward': False})
+        for observer in self.observers:
+            self._post(f'{observer}/members/{self.service}/leave', {'url': self.self_url})
+
+    def _post(self, url, data):
+        try:
+            response = http_client.post(url, json=data, timeout=(1.0, 2.0))
+            response.raise_for_status()
+            return response
+        except requests.exceptions.RequestException as e:
+            log.warning('Error contacting member', extra={'url': url, 'error': str(e)})
+            return None
+
+
+# Add the membership routes of a replicated server to its Flask app:
+# GET /members, and POST /members/join and /members/leave with {'url': ..., 'forward': bool}.
+def add_membership_routes(app, membership):
+    from flask import jsonify, request
+
+    @app.route('/members', methods=['GET'])
+    def list_members():
+        return jsonify({'members': membership.members()})
+
+    @app.route('/members/<action>', methods=['POST'])
+    def change_members(action):
+        data = request.get_json(silent=True) or {}
+        if action not in ('join', 'leave') or not data.get('url'):
+            return jsonify({'error': 'Invalid membership change'}), 400
+        changed = membership.join(data['url']) if action == 'join' else membership.leave(data['url'])
+        if changed and data.get('forward', True):
+            membership.forward(action, data['url'])
+        return jsonify({'members': membership.members()})
+
+
+# Add the routes through which servers join and leave the groups a frontend routes to:
+# GET /members/<service>, and POST /members/<service>/join and /members/<service>/leave
+# with {'url': ...}. `groups` maps a service name to its Membership.
+def add_observer_routes(app, groups):
+    from flask import jsonify, request
+
+    @app.route('/members/<service>', methods=['GET'])
+    def list_service_members(service):
+        if service not in groups:
+            return jsonify({'error': f'Unknown service {service}'}), 404
+        return jsonify({'members': groups[service].members()})
+
+    @app.route('/members/<service>/<action>', methods=['POST'])
+    def change_service_members(service, action):
+        data = request.get_json(silent=True) or {}
+        if service not in groups or action not in ('join', 'leave') or not data.get('url'):
+            return jsonify({'error': 'Invalid membership change'}), 400
+        if action == 'join':
+            groups[service].join(data['url'])
+        else:
+            groups[service].leave(data['url'])
+        return jsonify({'members': groups[service].members()})
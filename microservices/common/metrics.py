@@ -0,0 +1,233 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# A metric family: one value (or histogram) per combination of label values.
+# Label values are passed as keyword arguments and must name every label.
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        # label values (tuple) -> value
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, list(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+# Cumulative histogram with fixed bucket bounds, as Prometheus expects
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            state = self._values.get(key)
+            if state is None:
+                # [count per bucket, +Inf included], sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    # Observe how long the with-block takes
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', labels + [('le', _format_value(float(bound)))], cumulative))
+            samples.append((f'{self.name}_sum', labels, total))
+            samples.append((f'{self.name}_count', labels, cumulative))
+        return samples
+
+
+# The metrics of one process, rendered in the Prometheus text format.
+#
+# Besides the metrics updated as things happen, collectors registered with
+# collect() are called at scrape time to report values that are cheaper to read
+# off existing state (cache counters, replication positions). A collector
+# returns a list of (name, type, documentation, [(labels dict, value)]).
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    # Return the metric called `name`, creating it with cls(name, ...) on first use
+    def get_or_create(self, cls, name, *args, **kwargs):
+        with self.lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def collect(self, collector):
+        with self.lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        for collector in collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                log.error('Metrics collector failed', extra={'error': str(e)})
+                continue
+            for name, metric_type, documentation, samples in families:
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.get_or_create(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.get_or_create(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.get_or_create(Histogram, name, documentation, labelnames, buckets)
+
+
+def collect(collector):
+    REGISTRY.collect(collector)
+
+
+def render():
+    return REGISTRY.render()
+
+
+# Metrics every service reports about the requests it serves and the calls it makes
+REQUEST_DURATION = histogram('http_request_duration_seconds', 'Time to handle a request, by route',
+                             ('method', 'route', 'status'))
+REQUESTS_IN_FLIGHT = gauge('http_requests_in_flight', 'Requests being handled')
+REQUESTS_IN_FLIGHT.set(0)
+UPSTREAM_DURATION = histogram('upstream_request_duration_seconds', 'Time of a call to another server, by upstream',
+                              ('upstream', 'method', 'outcome'))
+UPSTREAM_IN_FLIGHT = gauge('upstream_requests_in_flight', 'Calls to another server in flight, by upstream',
+                           ('upstream',))
+
+
+# Outcome label of an upstream call: the status class ('2xx', '5xx', ...) or 'error' if there was no answer
+def outcome(status=None):
+    return 'error' if status is None else f'{status // 100}xx'
+
+
+# Record the latency and number in flight of every request a Flask app handles,
+# by route, and serve the metrics at GET /metrics.
+def instrument(app):
+    from flask import Response, g, request
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+
+    @app.after_request
+    def record_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def observe_request(exception):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return
+        REQUESTS_IN_FLIGHT.dec()
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_DURATION.observe(time.perf_counter() - start, method=request.method, route=route,
+                                 status=g.pop('metrics_status', 500))
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(render(), content_type=METRICS_CONTENT_TYPE)
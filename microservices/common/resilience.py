@@ -0,0 +1,162 @@
+import logging
+import os
+import threading
+import time
+
+import requests
+
+log = logging.getLogger(__name__)
+
+# Consecutive failures (no answer or a 5xx answer) after which an upstream's circuit opens
+BREAKER_FAILURES = int(os.environ.get('BREAKER_FAILURES', '5'))
+
+# Seconds an open circuit rejects calls before letting one trial call through
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', '5.0'))
+
+# Retries earned per request, and the most that can be saved up, across all upstreams
+RETRY_BUDGET_RATIO = float(os.environ.get('RETRY_BUDGET_RATIO', '0.1'))
+RETRY_BUDGET_MAX = float(os.environ.get('RETRY_BUDGET_MAX', '10'))
+
+# Seconds an incoming request may take, including the calls it makes (0 = no limit).
+# A caller can lower it by sending the time it has left in DEADLINE_HEADER.
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', '10.0'))
+DEADLINE_HEADER = 'X-Request-Deadline'
+
+
+# Raised instead of calling an upstream whose circuit is open
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+# Raised instead of calling an upstream when the incoming request has no time left
+class DeadlineExceeded(requests.exceptions.Timeout):
+    pass
+
+
+# Circuit breaker for one upstream (scheme + host + port).
+#
+# Closed, calls go through. After `failure_threshold` failures in a row it opens
+# and allow() rejects calls for `reset_timeout` seconds, so callers fail fast
+# instead of tying up threads on a server that is down or overloaded. Then it is
+# half open: one trial call goes through, and its outcome closes or reopens it.
+# A trial that never reports back (e.g. it was cancelled) is replaced by another
+# one after `reset_timeout` seconds.
+class CircuitBreaker:
+    def __init__(self, upstream, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.upstream = upstream
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+
+    # Whether a call may be made now; once the circuit is half open only the trial call gets through
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            now = time.monotonic()
+            if now - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self.opened_at = now
+                return True
+            return False
+
+    def record(self, ok):
+        with self.lock:
+            if ok:
+                if self.state != 'closed':
+                    log.info('Circuit closed', extra={'upstream': self.upstream})
+                self.state = 'closed'
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    log.warning('Circuit opened', extra={'upstream': self.upstream, 'failures': self.failures})
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.failures = 0
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+# Return the circuit breaker of an upstream, creating it on first use
+def breaker_for(upstream):
+    with _breakers_lock:
+        breaker = _breakers.get(upstream)
+        if breaker is None:
+            breaker = _breakers[upstream] = CircuitBreaker(upstream)
+        return breaker
+
+
+# State of every upstream's circuit: upstream -> 'closed', 'open' or 'half_open'
+def breaker_states():
+    with _breakers_lock:
+        return {upstream: breaker.state for upstream, breaker in _breakers.items()}
+
+
+# Process-wide retry budget: every request earns `ratio` of a retry, up to `max_tokens`,
+# and every retry spends a whole one. When an upstream is overloaded, retries stop
+# once the budget runs dry instead of multiplying the load on it.
+class RetryBudget:
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, max_tokens=RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    # Take one retry from the budget; returns False if there is none left
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+retry_budget = RetryBudget()
+
+# Deadline of the request being handled by the current thread (time.monotonic() value)
+_local = threading.local()
+
+
+def set_deadline(seconds):
+    _local.deadline = None if seconds is None else time.monotonic() + seconds
+
+
+# Seconds left before the current request's deadline, or None if it has none
+def remaining():
+    deadline = getattr(_local, 'deadline', None)
+    return None if deadline is None else deadline - time.monotonic()
+
+
+# Give every request handled by a Flask app a deadline: REQUEST_DEADLINE seconds, or
+# less if the caller sent what it has left in DEADLINE_HEADER. Calls made through
+# common.http_client while handling it are cut short at the deadline and pass on
+# the time left. A request that arrives with no time left is answered 504 at once.
+def propagate_deadlines(app):
+    from flask import jsonify, request
+
+    @app.before_request
+    def start_deadline():
+        budget = REQUEST_DEADLINE or None
+        try:
+            sent = float(request.headers.get(DEADLINE_HEADER, ''))
+            budget = sent if budget is None else min(budget, sent)
+        except ValueError:
+            pass
+        set_deadline(budget)
+        if budget is not None and budget <= 0:
+            return jsonify({'error': 'Deadline exceeded'}), 504
+
+    @app.teardown_request
+    def clear_deadline(exception):
+        set_deadline(None)
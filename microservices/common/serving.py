@@ -0,0 +1,29 @@
+import os
+import signal
+import sys
+
+# Number of request threads in production mode
+WEB_THREADS = int(os.environ.get('WEB_THREADS', '32'))
+
+# Maximum number of simultaneously open client connections in production mode
+WEB_CONNECTION_LIMIT = int(os.environ.get('WEB_CONNECTION_LIMIT', '1000'))
+
+
+# Run a service's Flask app.
+#
+# By default the app is served by waitress, a production WSGI server that runs
+# WEB_THREADS request threads in a single process. The services keep their state
+# (catalog store, journals, purchase pipeline, frontend cache) in process memory,
+# so they scale with threads rather than with forked worker processes.
+# SERVER_MODE=dev runs the Flask development server with the reloader and debugger.
+def serve(app, port):
+    # Exit normally on SIGTERM (e.g. docker stop) so atexit handlers, such as leaving the replica group, run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if os.environ.get('SERVER_MODE', 'production') == 'dev':
+        app.run(host='0.0.0.0', port=port, debug=True)
+        return
+
+    from waitress import serve as waitress_serve
+    waitress_serve(app, host='0.0.0.0', port=port, threads=WEB_THREADS,
+                   connection_limit=WEB_CONNECTION_LIMIT)
@@ -0,0 +1,45 @@
+import os
+
+# Header carrying a client's session token: the versions of the books its writes produced
+SESSION_HEADER = 'X-Session-Token'
+
+# Most books a session token remembers; the oldest ones are dropped first
+SESSION_TOKEN_MAX_BOOKS = int(os.environ.get('SESSION_TOKEN_MAX_BOOKS', '50'))
+
+
+# Session tokens give a client read-your-writes consistency across catalog replicas.
+#
+# A token lists the version every book written in the session was left at, as
+# 'id:version,id:version'. The catalog returns the versions it wrote, the order
+# server and the frontend pass them back to the client in SESSION_HEADER, and the
+# client sends the token along with its next reads. A catalog replica only
+# answers a read once it has applied at least those versions.
+
+# Parse a token into {book ID (str): version}; malformed parts are ignored
+def parse_token(token):
+    versions = {}
+    for part in (token or '').split(','):
+        book_id, _, version = part.strip().partition(':')
+        try:
+            version = int(version)
+        except ValueError:
+            continue
+        if book_id:
+            versions[book_id] = max(version, versions.get(book_id, 0))
+    return versions
+
+
+def format_token(versions):
+    return ','.join(f'{book_id}:{version}' for book_id, version in versions.items())
+
+
+# Combine tokens, keeping the highest version per book; None stands for no token.
+# Returns the merged token, or None if it is empty.
+def merge_tokens(*tokens):
+    versions = {}
+    for token in tokens:
+        for book_id, version in parse_token(token).items():
+            versions[book_id] = max(version, versions.pop(book_id, 0))
+    # Most recently written books last; keep only the newest SESSION_TOKEN_MAX_BOOKS
+    versions = dict(list(versions.items())[-SESSION_TOKEN_MAX_BOOKS:])
+    return format_token(versions) or None
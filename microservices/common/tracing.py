@@ -0,0 +1,277 @@
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# Where finished spans go: a JSON-lines file and/or a collector that accepts
+# POST {'spans': [...]}. Tracing is off unless at least one of them is set.
+TRACE_FILE = os.environ.get('TRACE_FILE', '')
+TRACE_COLLECTOR_URL = os.environ.get('TRACE_COLLECTOR_URL', '').rstrip('/')
+TRACING_ENABLED = bool(TRACE_FILE or TRACE_COLLECTOR_URL)
+
+# Fraction of new traces recorded; the decision travels with the trace to every server
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '1.0'))
+
+# Finished spans waiting to be exported; spans beyond this are dropped, never waited for
+TRACE_QUEUE_SIZE = int(os.environ.get('TRACE_QUEUE_SIZE', '10000'))
+
+# Seconds between exports of the finished spans
+TRACE_FLUSH_INTERVAL = float(os.environ.get('TRACE_FLUSH_INTERVAL', '1.0'))
+
+# W3C trace context header: 00-<trace ID>-<parent span ID>-<flags, 01 = sampled>
+TRACEPARENT_HEADER = 'traceparent'
+
+# Name of this server in the spans it records (set by trace_requests)
+service_name = os.environ.get('SERVICE_NAME', os.path.basename(sys.argv[0]).rsplit('.', 1)[0])
+
+# Span of the work the current thread (or asyncio task) is doing
+_current = contextvars.ContextVar('trace_span', default=None)
+
+
+# One timed operation of a trace: a request served, a call to another server or a file write.
+# Spans of traces that were not sampled are still created, so the trace context reaches
+# the next server, but they are never exported.
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, sampled=True, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self._start = time.perf_counter()
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    # Value of TRACEPARENT_HEADER for calls made on behalf of this span
+    def traceparent(self):
+        return f'00-{self.trace_id}-{self.span_id}-{"01" if self.sampled else "00"}'
+
+    def end(self, error=None):
+        if error is not None:
+            self.error = str(error) or type(error).__name__
+        if self.sampled:
+            exporter.export({
+                'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent_id,
+                'name': self.name,
+                'service': service_name,
+                'start': self.start,
+                'duration_ms': round((time.perf_counter() - self._start) * 1000, 3),
+                'attributes': self.attributes,
+                'error': self.error
+            })
+
+
+# Parse a TRACEPARENT_HEADER value into (trace ID, parent span ID, sampled), or None if malformed
+def parse_traceparent(value):
+    parts = (value or '').strip().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16), int(parts[3], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2], int(parts[3], 16) & 1 == 1
+
+
+def current_span():
+    return _current.get()
+
+
+# Start the span of a request this server received, continuing the caller's trace from
+# its TRACEPARENT_HEADER value or starting a new (possibly sampled-out) trace.
+# Returns None when tracing is off.
+def start_server_span(name, traceparent=None, **attributes):
+    if not TRACING_ENABLED:
+        return None
+    parent = parse_traceparent(traceparent)
+    if parent is None:
+        return Span(name, '%032x' % random.getrandbits(128), None, random.random() < TRACE_SAMPLE_RATE,
+                    attributes)
+    trace_id, parent_id, sampled = parent
+    return Span(name, trace_id, parent_id, sampled, attributes)
+
+
+# Run the with-block as a child span of `parent` (default: the current span) and make it
+# the current span meanwhile. Yields None, and records nothing, outside of any trace.
+@contextmanager
+def span(name, parent=None, **attributes):
+    parent = parent if parent is not None else _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.end(e)
+        raise
+    else:
+        child.end()
+    finally:
+        _current.reset(token)
+
+
+# Make `active` the current span for the with-block, e.g. in a worker thread
+@contextmanager
+def use_span(active):
+    token = _current.set(active)
+    try:
+        yield active
+    finally:
+        _current.reset(token)
+
+
+# `headers` plus the TRACEPARENT_HEADER of the current span, if there is one
+def inject(headers=None):
+    active = _current.get()
+    if active is None:
+        return headers
+    return dict(headers or {}, **{TRACEPARENT_HEADER: active.traceparent()})
+
+
+# Writes finished spans to TRACE_FILE and/or posts them to TRACE_COLLECTOR_URL from
+# a background thread, every TRACE_FLUSH_INTERVAL seconds. export() never blocks:
+# when the queue is full the span is dropped and counted.
+class SpanExporter:
+    def __init__(self, filename=TRACE_FILE, collector_url=TRACE_COLLECTOR_URL, max_queued=TRACE_QUEUE_SIZE,
+                 flush_interval=TRACE_FLUSH_INTERVAL):
+        self.filename = filename
+        self.collector_url = collector_url
+        self.flush_interval = flush_interval
+        self.pending = queue.Queue(maxsize=max_queued)
+        self.dropped = 0
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def export(self, record):
+        if self.worker is None:
+            self._start()
+        try:
+            self.pending.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, daemon=True)
+                self.worker.start()
+
+    # Export everything queued so far; returns the number of spans exported
+    def flush(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        if not batch:
+            return 0
+        if self.filename:
+            with open(self.filename, 'a', encoding='utf-8') as trace_file:
+                trace_file.write(''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in batch))
+        if self.collector_url:
+            import requests
+            from common import http_client
+            try:
+                http_client.post(self.collector_url, json={'spans': batch}, retries=0).raise_for_status()
+            except requests.exceptions.RequestException as e:
+                log.warning('Error exporting spans', extra={'spans': len(batch), 'url': self.collector_url, 'error': str(e)})
+        return len(batch)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                log.warning('Error exporting spans', extra={'error': str(e)})
+
+
+exporter = SpanExporter()
+
+
+# Record a span for every request a Flask app handles, continuing the caller's trace.
+# Calls made through common.http_client while handling it become child spans and
+# carry the trace on to the next server.
+def trace_requests(app, service=None):
+    global service_name
+    if service is not None:
+        service_name = service
+    if not TRACING_ENABLED:
+        return
+    from flask import g, request
+
+    @app.before_request
+    def start_request_span():
+        route = request.url_rule.rule if request.url_rule is not None else request.path
+        g.trace_span = start_server_span(f'{request.method} {route}', request.headers.get(TRACEPARENT_HEADER),
+                                         path=request.path)
+        g.trace_token = _current.set(g.trace_span)
+
+    @app.after_request
+    def record_status(response):
+        active = g.get('trace_span')
+        if active is not None:
+            active.set('status', response.status_code)
+        return response
+
+    @app.teardown_request
+    def end_request_span(exception):
+        active = g.pop('trace_span', None)
+        if active is None:
+            return
+        _current.reset(g.pop('trace_token'))
+        active.end(exception)
+
+
+# Print the traces in a TRACE_FILE as trees of spans with their durations, slowest trace first:
+#   python common/tracing.py traces.jsonl [number of traces]
+def print_traces(filename, limit=10):
+    traces = {}
+    with open(filename, encoding='utf-8') as trace_file:
+        for line in trace_file:
+            record = json.loads(line)
+            traces.setdefault(record['trace_id'], []).append(record)
+
+    def duration(spans):
+        return max(record['duration_ms'] for record in spans if record['parent_id'] not in
+                   {other['span_id'] for other in spans}) if spans else 0
+
+    for trace_id, spans in sorted(traces.items(), key=lambda item: -duration(item[1]))[:limit]:
+        print(f'trace {trace_id}')
+        children = {}
+        span_ids = {record['span_id'] for record in spans}
+        for record in spans:
+            children.setdefault(record['parent_id'] if record['parent_id'] in span_ids else None, []).append(record)
+
+        def show(record, depth):
+            offset = (record['start'] - root_start) * 1000
+            error = f'  ERROR {record["error"]}' if record['error'] else ''
+            print(f'  {"  " * depth}{record["name"]} [{record["service"]}] +{offset:.1f}ms {record["duration_ms"]}ms{error}')
+            for child in sorted(children.get(record['span_id'], []), key=lambda child: child['start']):
+                show(child, depth + 1)
+
+        roots = sorted(children.get(None, []), key=lambda record: record['start'])
+        root_start = roots[0]['start'] if roots else 0
+        for root in roots:
+            show(root, 0)
+
+
+if __name__ == '__main__':
+    print_traces(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 10)
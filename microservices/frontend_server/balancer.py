@@ -0,0 +1,160 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+from common import http_client
+
+log = logging.getLogger(__name__)
+
+# How the next replica is picked: 'least_outstanding' (fewest requests in flight,
+# then lowest latency) or 'ewma' (lowest latency, weighted by requests in flight)
+LB_POLICY = os.environ.get('LB_POLICY', 'least_outstanding')
+
+# Seconds between active health checks of every replica (0 = no active checks)
+LB_HEALTH_INTERVAL = float(os.environ.get('LB_HEALTH_INTERVAL', '2.0'))
+
+# Consecutive failed requests after which a replica is ejected, and for how many seconds
+LB_EJECT_AFTER = int(os.environ.get('LB_EJECT_AFTER', '3'))
+LB_EJECT_SECONDS = float(os.environ.get('LB_EJECT_SECONDS', '10.0'))
+
+# Weight of the newest sample in the latency moving average
+LB_EWMA_ALPHA = float(os.environ.get('LB_EWMA_ALPHA', '0.3'))
+
+
+# What the balancer knows about one replica
+class Backend:
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.latency = 0.0
+        self.failures = 0
+        self.healthy = True
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def available(self, now):
+        return self.healthy and self.ejected_until <= now
+
+
+# Thread-safe load balancer over the replicas of one service.
+#
+# Every request is wrapped in track(url), which counts it as outstanding and, when
+# it ends, folds its latency into the replica's moving average. A replica that fails
+# LB_EJECT_AFTER requests in a row is ejected for LB_EJECT_SECONDS (passive outlier
+# detection), and a background thread GETs `health_path` on every replica every
+# LB_HEALTH_INTERVAL seconds, taking failing replicas out until they answer again.
+# choose() and ranked() only consider replicas that are healthy and not ejected,
+# unless there are none, in which case every replica is tried.
+class Balancer:
+    def __init__(self, service, urls=(), policy=LB_POLICY, health_path='/health',
+                 health_interval=LB_HEALTH_INTERVAL):
+        self.service = service
+        self.policy = policy
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self.lock = threading.Lock()
+        self._backends = {}
+        for url in urls:
+            self.add(url)
+        if health_interval > 0:
+            threading.Thread(target=self._check_health, daemon=True).start()
+
+    def add(self, url):
+        with self.lock:
+            self._backends.setdefault(url, Backend(url))
+
+    def remove(self, url):
+        with self.lock:
+            self._backends.pop(url, None)
+
+    # URLs of the replicas that can take requests, best first
+    def ranked(self):
+        now = time.monotonic()
+        with self.lock:
+            backends = list(self._backends.values())
+            candidates = [backend for backend in backends if backend.available(now)] or backends
+            return [backend.url for backend in sorted(candidates, key=self._score)]
+
+    # URL of the best replica for the next request, or None if there are none
+    def choose(self):
+        ranked = self.ranked()
+        return ranked[0] if ranked else None
+
+    # Count a request to `url` while it runs; an exception marks it as failed.
+    # Requests cancelled from outside (e.g. a hedged request that lost) count neither way.
+    @contextmanager
+    def track(self, url):
+        with self.lock:
+            backend = self._backends.get(url)
+            if backend is not None:
+                backend.outstanding += 1
+        start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self._finish(url, None, failed=True)
+            raise
+        except BaseException:
+            self._finish(url, None, failed=False)
+            raise
+        self._finish(url, time.monotonic() - start, failed=False)
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return {backend.url: {
+                'available': backend.available(now),
+                'healthy': backend.healthy,
+                'ejected': backend.ejected_until > now,
+                'outstanding': backend.outstanding,
+                'latency': round(backend.latency, 6),
+                'requests': backend.requests,
+                'errors': backend.errors
+            } for backend in self._backends.values()}
+
+    def _score(self, backend):
+        if self.policy == 'ewma':
+            return (backend.latency * (backend.outstanding + 1), backend.outstanding)
+        return (backend.outstanding, backend.latency)
+
+    def _finish(self, url, latency, failed):
+        with self.lock:
+            backend = self._backends.get(url)
+            if backend is None:
+                return
+            backend.outstanding -= 1
+            if failed:
+                backend.requests += 1
+                backend.errors += 1
+                backend.failures += 1
+                if backend.failures >= LB_EJECT_AFTER:
+                    backend.ejected_until = time.monotonic() + LB_EJECT_SECONDS
+                    backend.failures = 0
+                    log.warning('Ejecting server', extra={'group': self.service, 'url': url, 'seconds': LB_EJECT_SECONDS})
+            elif latency is not None:
+                backend.requests += 1
+                backend.failures = 0
+                backend.latency = latency if backend.latency == 0 else \
+                    LB_EWMA_ALPHA * latency + (1 - LB_EWMA_ALPHA) * backend.latency
+
+    def _check_health(self):
+        while True:
+            time.sleep(self.health_interval)
+            with self.lock:
+                urls = list(self._backends)
+            for url in urls:
+                try:
+                    healthy = http_client.get(f'{url}{self.health_path}', retries=0,
+                                              timeout=(0.5, 1.0)).status_code == 200
+                except requests.exceptions.RequestException:
+                    healthy = False
+                with self.lock:
+                    backend = self._backends.get(url)
+                    if backend is not None and backend.healthy != healthy:
+                        backend.healthy = healthy
+                        log.info('Server is healthy' if healthy else 'Server is unhealthy', extra={'group': self.service, 'url': url})
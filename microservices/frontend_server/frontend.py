@@ -1,156 +1,319 @@
 from flask import Flask, jsonify, request
 import requests
-from collections import OrderedDict
+import logging
+import os
+import sys
 import time  
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import http_client
+from common.config import url_list
+from common.serving import serve
+from common.resilience import breaker_states, propagate_deadlines
+from common.metrics import collect, instrument
+from common.logs import log_routes, log_sampled, setup_logging
+from common.tracing import trace_requests
+from common.membership import Membership, add_observer_routes
+from common.session import SESSION_HEADER, format_token, merge_tokens, parse_token
+from balancer import Balancer
+from lru_cache import CatalogCache
+from single_flight import SingleFlight
+
 app = Flask(__name__)
+log = logging.getLogger('frontend')
+
+# Latency and in-flight metrics for every route, served at /metrics
+instrument(app)
+
+# Every request gets a deadline that bounds the calls it makes to other servers
+propagate_deadlines(app)
+
+# Structured log records, written off the request threads (see common/logs.py)
+setup_logging('frontend')
+log_routes(app)
+
+# A span for every request, continuing the caller's trace (see common/tracing.py)
+trace_requests(app, 'frontend')
 
-# Define URLs for catalog and order servers
-CATALOG_SERVER_URLS = ['http://localhost:5000', 'http://localhost:5003']
-ORDER_SERVER_URLS = ['http://localhost:5001', 'http://localhost:5004']
+# Health-aware balancers over the catalog and order servers (see balancer.py)
+catalog_balancer = Balancer('catalog')
+order_balancer = Balancer('order')
 
-# Limit the cache size
-MAX_CACHE_SIZE = 100
+# Catalog and order servers to balance over, seeded from the environment and updated
+# as servers join and leave the groups (POST /members/<service>/join or leave)
+catalog_servers = Membership('catalog', None, url_list('CATALOG_SERVER_URLS', 'http://localhost:5000,http://localhost:5003'),
+                             on_join=catalog_balancer.add, on_leave=catalog_balancer.remove)
+order_servers = Membership('order', None, url_list('ORDER_SERVER_URLS', 'http://localhost:5001,http://localhost:5004'),
+                           on_join=order_balancer.add, on_leave=order_balancer.remove)
+add_observer_routes(app, {'catalog': catalog_servers, 'order': order_servers})
 
-# In-memory cache with LRU policy
-cache = OrderedDict()
+# Limit the cache size (entries and approximate bytes) and optionally the age of entries
+MAX_CACHE_SIZE = int(os.environ.get('CACHE_MAX_ENTRIES', '100'))
+MAX_CACHE_BYTES = int(os.environ.get('CACHE_MAX_BYTES', str(1024 * 1024)))
+CACHE_TTL = float(os.environ.get('CACHE_TTL', '0')) or None
 
-# Load balancing algorithm (round-robin)
-catalog_index = 0
-order_index = 0
+# Seconds after which a cached entry is revalidated with a conditional GET (0 = never)
+CACHE_REVALIDATE_AFTER = float(os.environ.get('CACHE_REVALIDATE_AFTER', '5')) or None
 
-# Track cache hits and misses
-cache_hits = 0
-cache_misses = 0
+# Thread-safe in-memory LRU caches, one namespace each for /search and /info results
+cache = CatalogCache(MAX_CACHE_SIZE, MAX_CACHE_BYTES, CACHE_TTL, CACHE_REVALIDATE_AFTER)
+collect(cache.metric_families)
 
-# Get the next catalog server URL using round-robin.
+# Answer with a stale entry at once while a single background request revalidates it (1),
+# instead of revalidating it before answering (0)
+CACHE_STALE_WHILE_REVALIDATE = os.environ.get('CACHE_STALE_WHILE_REVALIDATE', '0') == '1'
+
+# Concurrent cache misses for the same key share one catalog request (see single_flight.py)
+flights = SingleFlight()
+
+# Get the healthy catalog server with the fewest outstanding requests (or lowest latency).
 def get_next_catalog_server():
-    global catalog_index
-    catalog_index = (catalog_index + 1) % len(CATALOG_SERVER_URLS)
-    return CATALOG_SERVER_URLS[catalog_index]
+    return catalog_balancer.choose()
 
-# Get the next order server URL using round-robin.
+# Get the healthy order server with the fewest outstanding requests (or lowest latency).
 def get_next_order_server():
-    global order_index
-    order_index = (order_index + 1) % len(ORDER_SERVER_URLS)
-    return ORDER_SERVER_URLS[order_index]
+    return order_balancer.choose()
+
+# Send a request to the server at `server_url`, letting `balancer` record its latency
+# and whether it failed (no answer or a 5xx answer, which is raised as an exception)
+def call(balancer, server_url, method, path, **kwargs):
+    with balancer.track(server_url):
+        response = http_client.request(method, f'{server_url}{path}', **kwargs)
+        if response.status_code >= 500:
+            response.raise_for_status()
+        return response
+
+# Send a catalog read to the best catalog server that has applied the client's writes.
+# The client's session token (see common/session.py) is passed on; a server that has
+# not caught up answers 412, and one that fails (no answer, a 5xx answer or an open
+# circuit) is skipped, and the next best one is tried. If none has caught up the last
+# 412 response is returned; if every server failed the last error is raised.
+def read_catalog(path, token=None, headers=None, **kwargs):
+    if token:
+        headers = dict(headers or {}, **{SESSION_HEADER: token})
+    response = None
+    error = None
+    for catalog_server_url in catalog_balancer.ranked():
+        log_sampled(log, 'Reading from catalog server', url=catalog_server_url)
+        try:
+            response = call(catalog_balancer, catalog_server_url, 'GET', path, headers=headers, **kwargs)
+        except requests.exceptions.RequestException as e:
+            log.warning('Error reading from catalog server', extra={'url': catalog_server_url, 'error': str(e)})
+            error = e
+            continue
+        if response.status_code != 412:
+            return response
+    if response is not None:
+        return response
+    raise error or requests.exceptions.ConnectionError('No catalog server available')
+
+# Whether a cached /info result is at least as new as the client's own writes to the book
+def meets_session(result, item_number, session):
+    return result.get('version', 0) >= session.get(str(item_number), 0)
 
 # Measure time taken
 def measure_time():
     return time.time()
 
-# Invalidate cache for a specific item number.
+# Invalidate the cached info for an item number and the cached search results that list it.
 @app.route('/invalidate_cache/<item_number>', methods=['POST'])
 def invalidate_cache(item_number):
-    global cache
     try:
         start_time = measure_time()  # Record the start time
 
-        if item_number in cache:
-            cache.pop(item_number)
-            print(f'Cache invalidated successfully for item {item_number}')
+        if cache.invalidate_book(item_number):
             end_time = measure_time()  # Record the end time
-            print(f'Time Taken for Cache Invalidation: {end_time - start_time:.5f} seconds')
+            log_sampled(log, 'Cache invalidated', item_number=item_number, seconds=round(end_time - start_time, 5))
             return jsonify({'message': f'Cache invalidated successfully for item {item_number}'})
         else:
             return jsonify({'error': f'Item {item_number} not found in cache'}), 404
     except Exception as e:
-        print(f"Error during cache invalidation: {str(e)}")
+        log.error('Error during cache invalidation', extra={'item_number': item_number, 'error': str(e)})
         return jsonify({'error': f'Internal server error during cache invalidation: {str(e)}'}), 500
 
+# Invalidate a batch of items published by the catalog servers: {'items': {item_number: version}}.
+# Invalidations older than what the cache already holds are ignored.
+@app.route('/invalidate_cache', methods=['POST'])
+def invalidate_cache_batch():
+    versions = (request.get_json(silent=True) or {}).get('items', {})
+    removed = cache.invalidate_books(versions)
+    log_sampled(log, 'Cache invalidated', removed=removed, item_numbers=list(versions))
+    return jsonify({'invalidated': removed})
+
 # Search for items and utilize caching.
+# Concurrent misses for the same query share one catalog request. Search results
+# only list IDs and titles, which a client's writes never change, so the session
+# token is not passed on and every client's misses for the query are shared.
 @app.route('/search/<item_name>', methods=['GET'])
 def search_items(item_name):
     """Search for items and utilize caching."""
-    global cache_hits, cache_misses
-
-    if item_name in cache:
-        cache.move_to_end(item_name)
-        cache_hits += 1
-        print(f'Cache Hit! Item Name: {item_name}, Cache Capacity: {len(cache)}/{MAX_CACHE_SIZE}, Time Taken: 0.00000 seconds')
-        return jsonify(cache[item_name])
-
+    cached = cache.get_search(item_name)
+    if cached is not None and cached[2]:
+        log_sampled(log, 'Cache hit', item_name=item_name, cache_entries=len(cache.search))
+        return jsonify(cached[0])
+
+    key = ('search', item_name)
+    if cached is not None and CACHE_STALE_WHILE_REVALIDATE:
+        flights.start(key, lambda: fetch_search(item_name, cached))
+        log_sampled(log, 'Cache stale, revalidating in the background', item_name=item_name)
+        return jsonify(cached[0])
+    return jsonify(flights.do(key, lambda: fetch_search(item_name, cached)))
+
+# Fetch /search results from the catalog servers and cache them. A stale `cached`
+# entry is only fetched again if the catalog changed since. Returns the results,
+# or {'error': ...} if no catalog server could answer.
+def fetch_search(item_name, cached):
     try:
         start_time = time.time()  # Record the start time
-        catalog_server_url = get_next_catalog_server()
-        print(f'Search endpoint. Using catalog server: {catalog_server_url}')
 
-        response = requests.get(f'{catalog_server_url}/search/{item_name}')
+        headers = {'If-None-Match': cached[1]} if cached is not None and cached[1] else None
+        response = read_catalog(f'/search/{item_name}', headers=headers)
+        if response.status_code == 304 and cached is not None:
+            cache.revalidated_search(item_name)
+            log_sampled(log, 'Cache revalidated', item_name=item_name, seconds=round(time.time() - start_time, 5))
+            return cached[0]
         response.raise_for_status()
 
         result = response.json()
 
-        if len(cache) >= MAX_CACHE_SIZE:
-            # Clear the entire cache and start caching again
-            cache.clear()
-
-        cache[item_name] = result
-        cache_misses += 1
+        # Least recently used entries are evicted one by one if the cache is full
+        cache.put_search(item_name, result, response.headers.get('ETag'))
         end_time = time.time()  # Record the end time
-        print(f'Cache Miss! Item Name: {item_name}, Cache Capacity: {len(cache)}/{MAX_CACHE_SIZE}, Time Taken: {end_time - start_time:.5f} seconds')
+        log_sampled(log, 'Cache miss', item_name=item_name, cache_entries=len(cache.search),
+                    seconds=round(end_time - start_time, 5))
 
-        return jsonify(result)
+        return result
     except requests.exceptions.RequestException as e:
-        print(f"Error: {e}")
-        return jsonify({'error': f'Catalog server error: {str(e)}'})
+        log.warning('Error searching the catalog', extra={'item_name': item_name, 'error': str(e)})
+        return {'error': f'Catalog server error: {str(e)}'}
 
 # Retrieve information about a book based on the provided item number.
+# Concurrent misses for the same book share one catalog request if their session
+# tokens require the same version of it; only that version is passed on.
 @app.route('/info/<item_number>', methods=['GET'])
 def book_info(item_number):
-    global cache_hits, cache_misses
+    # A hit also marks the item as most recently used
+    cached = cache.get_info(item_number)
+    # An entry older than the client's own last write to the book is not used
+    session = parse_token(request.headers.get(SESSION_HEADER))
+    if cached is not None and not meets_session(cached[0], item_number, session):
+        cached = None
+    if cached is not None and cached[2]:
+        log_sampled(log, 'Cache hit', item_number=item_number, cache_entries=len(cache.info))
+        return cached[0]
+
+    required = session.get(str(item_number))
+    key = ('info', item_number, required)
+    if cached is not None and CACHE_STALE_WHILE_REVALIDATE:
+        flights.start(key, lambda: fetch_info(item_number, cached, required))
+        log_sampled(log, 'Cache stale, revalidating in the background', item_number=item_number)
+        return cached[0]
+    return flights.do(key, lambda: fetch_info(item_number, cached, required))
+
+# Fetch a book's info from the catalog servers and cache it. A stale `cached` entry
+# is only fetched again if the book changed since. With `required`, only a server
+# that has applied that version of the book answers. Returns the info, or {'error': ...},
+# which is not cached.
+def fetch_info(item_number, cached, required):
+    try:
+        start_time = time.time()  # Record the start time
+        headers = {'If-None-Match': cached[1]} if cached is not None and cached[1] else None
+        token = format_token({item_number: required}) if required else None
+        response = read_catalog(f'/info/{item_number}', token, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            cache.revalidated_info(item_number)
+            log_sampled(log, 'Cache revalidated', item_number=item_number, seconds=round(time.time() - start_time, 5))
+            return cached[0]
+        if response.status_code == 412:
+            return {'error': 'No catalog server has caught up with this session'}
+        response.raise_for_status()
 
-    # Load balancing for catalog servers
-    catalog_server_url = get_next_catalog_server()
-    print(f'Book info endpoint. Using catalog server: {catalog_server_url}')
+        result = response.json()
+        if 'error' in result:
+            return result
 
-    if item_number in cache:
-        # Move the accessed item to the end to mark it as most recently used
-        cache.move_to_end(item_number)
-        cache_hits += 1
-        print(f'Cache Hit! Item Number: {item_number}, Cache Capacity: {len(cache)}/{MAX_CACHE_SIZE}, Time Taken: 0.00000 seconds')
-        return cache[item_number]
+        # Cache the response, evicting least recently used entries if the cache is full
+        cache.put_info(item_number, result, response.headers.get('ETag'))
+        end_time = time.time()  # Record the end time
+        log_sampled(log, 'Cache miss', item_number=item_number, cache_entries=len(cache.info),
+                    seconds=round(end_time - start_time, 5))
 
-    try:
-        start_time = time.time()  # Record the start time
-        for catalog_server_url in CATALOG_SERVER_URLS:
-            response = requests.get(f'{catalog_server_url}/info/{item_number}')
-            if response.status_code == 200:
-                response.raise_for_status()
-                result = response.json()
-
-                # Cache the response and clear the entire cache if it reaches the maximum size
-                if len(cache) >= MAX_CACHE_SIZE:
-                    cache.clear()
-
-                cache[item_number] = result
-                cache_misses += 1
-                end_time = time.time()  # Record the end time
-                print(f'Cache Miss! Item Number: {item_number}, Cache Capacity: {len(cache)}/{MAX_CACHE_SIZE}, Time Taken: {end_time - start_time:.5f} seconds')
-
-                return result
-        return jsonify({'error': 'Book not found'})
+        return result
     except requests.exceptions.RequestException as e:
-        return jsonify({'error': f'Catalog server error: {str(e)}'})
+        log.warning('Error reading book info', extra={'item_number': item_number, 'error': str(e)})
+        return {'error': f'Catalog server error: {str(e)}'}
+
+# Retrieve information about several books in one call: /info?ids=1,2,3.
+# Books with a fresh cache entry are answered from the cache; all the others are
+# fetched from a catalog server in a single request.
+@app.route('/info', methods=['GET'])
+def books_info():
+    item_numbers = list(dict.fromkeys(item_number for item_number in request.args.get('ids', '').split(',') if item_number))
+    session = parse_token(request.headers.get(SESSION_HEADER))
+    results = {}
+    misses = []
+    for item_number in item_numbers:
+        cached = cache.get_info(item_number)
+        if cached is not None and cached[2] and meets_session(cached[0], item_number, session):
+            results[item_number] = cached[0]
+        else:
+            misses.append(item_number)
+
+    if misses:
+        try:
+            start_time = time.time()  # Record the start time
+            response = read_catalog('/info', request.headers.get(SESSION_HEADER), params={'ids': ','.join(misses)})
+            response.raise_for_status()
+            fetched = response.json()
+            log_sampled(log, 'Bulk info', hits=len(item_numbers) - len(misses), misses=len(misses),
+                        seconds=round(time.time() - start_time, 5))
+        except requests.exceptions.RequestException as e:
+            return jsonify({'error': f'Catalog server error: {str(e)}'})
+
+        for item_number in misses:
+            result = fetched.get(item_number, {'error': 'Book not found'})
+            if 'error' not in result:
+                cache.put_info(item_number, result)
+            results[item_number] = result
+
+    return jsonify(results)
+
+# Report cache occupancy, hit/miss/eviction counters and how many misses were coalesced.
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(dict(cache.stats(), single_flight=flights.stats()))
+
+# Report the state of every catalog and order server as seen by the load balancers,
+# and the state of the circuit to every upstream.
+@app.route('/balancer_stats', methods=['GET'])
+def balancer_stats():
+    return jsonify({'catalog': catalog_balancer.stats(), 'order': order_balancer.stats(),
+                    'circuits': breaker_states()})
 
 # Purchase a book based on the provided item number.
+# The response carries the client's session token, updated with this purchase.
 @app.route('/purchase/<item_number>', methods=['POST'])
 def purchase_book(item_number):
 
     # Load balancing for order servers
     order_server_url = get_next_order_server()
-    print(f'Purchase endpoint. Using order server: {order_server_url}')
+    log_sampled(log, 'Purchasing through order server', url=order_server_url)
 
     try:
         start_time = time.time()  # Record the start time
-        response = requests.post(f'{order_server_url}/purchase/{item_number}')
+        response = call(order_balancer, order_server_url, 'POST', f'/purchase/{item_number}')
         response.raise_for_status()
         end_time = time.time()  # Record the end time
 
-        print(f'Time Taken for Purchase: {end_time - start_time:.5f} seconds')
+        log_sampled(log, 'Purchase', item_number=item_number, seconds=round(end_time - start_time, 5))
 
-        return response.json()
+        result = jsonify(response.json())
+        token = merge_tokens(request.headers.get(SESSION_HEADER), response.headers.get(SESSION_HEADER))
+        if token is not None:
+            result.headers[SESSION_HEADER] = token
+        return result
     except requests.exceptions.RequestException as e:
         return jsonify({'error': f'Order server error: {str(e)}'})
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5002, debug=True)
+    serve(app, int(os.environ.get('PORT', '5002')))
@@ -0,0 +1,481 @@
+import asyncio
+import contextvars
+import logging
+import os
+import sys
+import time
+from urllib.parse import quote, urlsplit
+
+import aiohttp
+from aiohttp import web
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.config import url_list
+from common.http_client import upstream_of
+from common.metrics import (METRICS_CONTENT_TYPE, REQUEST_DURATION, REQUESTS_IN_FLIGHT, UPSTREAM_DURATION,
+                            UPSTREAM_IN_FLIGHT, collect, outcome, render)
+from common.logs import current_route, log_sampled, setup_logging
+from common.membership import Membership
+from common.resilience import DEADLINE_HEADER, REQUEST_DEADLINE, breaker_for
+from common.session import SESSION_HEADER, format_token, merge_tokens, parse_token
+from common import tracing
+from balancer import Balancer
+from lru_cache import CatalogCache
+from single_flight import AsyncSingleFlight
+
+# Asyncio variant of frontend.py: same routes, but upstream calls never block a
+# thread, so one process can hold thousands of requests in flight. Catalog reads
+# are hedged across the catalog replicas (see hedged_get).
+
+log = logging.getLogger('frontend')
+
+# Health-aware balancers over the catalog and order servers (see balancer.py)
+catalog_balancer = Balancer('catalog')
+order_balancer = Balancer('order')
+
+# Catalog and order servers to balance over, seeded from the environment and updated
+# as servers join and leave the groups (POST /members/<service>/join or leave)
+catalog_servers = Membership('catalog', None, url_list('CATALOG_SERVER_URLS', 'http://localhost:5000,http://localhost:5003'),
+                             on_join=catalog_balancer.add, on_leave=catalog_balancer.remove)
+order_servers = Membership('order', None, url_list('ORDER_SERVER_URLS', 'http://localhost:5001,http://localhost:5004'),
+                           on_join=order_balancer.add, on_leave=order_balancer.remove)
+
+# Seconds to wait for a catalog replica before also asking the next one (0 = ask all at once)
+HEDGE_DELAY = float(os.environ.get('HEDGE_DELAY', '0.05'))
+
+# Upstream connection pool size and total timeout per upstream call
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '100'))
+HTTP_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '10.0'))
+
+# Limit the cache size (entries and approximate bytes) and optionally the age of entries
+MAX_CACHE_SIZE = int(os.environ.get('CACHE_MAX_ENTRIES', '100'))
+MAX_CACHE_BYTES = int(os.environ.get('CACHE_MAX_BYTES', str(1024 * 1024)))
+CACHE_TTL = float(os.environ.get('CACHE_TTL', '0')) or None
+
+# Seconds after which a cached entry is revalidated with a conditional GET (0 = never)
+CACHE_REVALIDATE_AFTER = float(os.environ.get('CACHE_REVALIDATE_AFTER', '5')) or None
+
+# In-memory LRU caches, one namespace each for /search and /info results
+cache = CatalogCache(MAX_CACHE_SIZE, MAX_CACHE_BYTES, CACHE_TTL, CACHE_REVALIDATE_AFTER)
+collect(cache.metric_families)
+
+# Answer with a stale entry at once while a single background request revalidates it (1),
+# instead of revalidating it before answering (0)
+CACHE_STALE_WHILE_REVALIDATE = os.environ.get('CACHE_STALE_WHILE_REVALIDATE', '0') == '1'
+
+# Concurrent cache misses for the same key share one catalog request (see single_flight.py)
+flights = AsyncSingleFlight()
+
+# Deadline of the request being handled (loop.time() value), inherited by the tasks it starts
+request_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+# Get the healthy order server with the fewest outstanding requests (or lowest latency).
+def get_next_order_server():
+    return order_balancer.choose()
+
+
+# A catalog server has not caught up with the client's session yet (it answered 412)
+class SessionBehind(aiohttp.ClientError):
+    pass
+
+
+# Returns (result, response headers). With `etag` the request is conditional and the
+# result is None if the server answered 304 Not Modified. With `token` the client's
+# session token is passed on (see common/session.py); a server that has not applied
+# its writes yet raises SessionBehind.
+# The call goes through the upstream's circuit breaker (see common/resilience.py)
+# and passes on the time left before the request's deadline.
+async def fetch_json(session, method, url, etag=None, token=None):
+    headers = {'If-None-Match': etag} if etag else {}
+    if token:
+        headers[SESSION_HEADER] = token
+    deadline = request_deadline.get()
+    if deadline is not None:
+        headers[DEADLINE_HEADER] = f'{deadline - asyncio.get_running_loop().time():.3f}'
+    upstream = upstream_of(url)
+    breaker = breaker_for(upstream)
+    if not breaker.allow():
+        raise aiohttp.ClientConnectionError(f'Circuit to {breaker.upstream} is open')
+    UPSTREAM_IN_FLIGHT.inc(upstream=upstream)
+    start = time.perf_counter()
+    status = None
+    cancelled = False
+    try:
+        # A client span of the current trace; the next server continues the trace from it
+        with tracing.span(f'{method} {urlsplit(url).path}', upstream=upstream) as client_span:
+            async with session.request(method, url, headers=tracing.inject(headers)) as response:
+                status = response.status
+                if client_span is not None:
+                    client_span.set('status', status)
+                breaker.record(response.status < 500)
+                if response.status == 304:
+                    return None, response.headers
+                if response.status == 412:
+                    raise SessionBehind(f'{url} has not caught up with the session')
+                response.raise_for_status()
+                return await response.json(), response.headers
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+        breaker.record(False)
+        raise
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    finally:
+        UPSTREAM_IN_FLIGHT.dec(upstream=upstream)
+        # A call cancelled because another hedged one won has no outcome to report
+        if status is not None or not cancelled:
+            UPSTREAM_DURATION.observe(time.perf_counter() - start, upstream=upstream, method=method,
+                                      outcome=outcome(status))
+
+
+# fetch_json() from the server at `server_url`, letting `balancer` record its latency
+# and whether it failed. A request cancelled because another one won counts neither way,
+# and neither does a server that is merely behind the session.
+async def call(session, balancer, server_url, method, path, etag=None, token=None):
+    behind = None
+    with balancer.track(server_url):
+        try:
+            return await fetch_json(session, method, f'{server_url}{path}', etag, token)
+        except SessionBehind as e:
+            behind = e
+    raise behind
+
+
+# GET `path` from the catalog replicas, hedging slow ones.
+# The replicas are tried best first, as ranked by the balancer. The first one is asked right away; every HEDGE_DELAY seconds without an
+# answer the next replica is asked as well. The first successful response wins
+# and the requests still in flight are cancelled; replicas behind the client's
+# session (`token`) count as failed, so the next one is asked right away.
+async def hedged_get(session, path, etag=None, token=None):
+    pending = set()
+    errors = []
+    replicas = iter(catalog_balancer.ranked())
+    try:
+        for url in replicas:
+            pending.add(asyncio.ensure_future(call(session, catalog_balancer, url, 'GET', path, etag, token)))
+            if HEDGE_DELAY > 0:
+                break
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=HEDGE_DELAY or None,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                errors.append(task.exception())
+            # Nothing good yet (slow or failed): bring in the next replica
+            next_url = next(replicas, None)
+            if next_url is not None:
+                pending.add(asyncio.ensure_future(call(session, catalog_balancer, next_url, 'GET', path, etag, token)))
+        raise errors[-1] if errors else aiohttp.ClientError('No catalog server available')
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+# Invalidate the cached info for an item number and the cached search results that list it.
+async def invalidate_cache(request):
+    item_number = request.match_info['item_number']
+    if cache.invalidate_book(item_number):
+        log_sampled(log, 'Cache invalidated', item_number=item_number)
+        return web.json_response({'message': f'Cache invalidated successfully for item {item_number}'})
+    return web.json_response({'error': f'Item {item_number} not found in cache'}, status=404)
+
+
+# Invalidate a batch of items published by the catalog servers: {'items': {item_number: version}}.
+# Invalidations older than what the cache already holds are ignored.
+async def invalidate_cache_batch(request):
+    versions = (await request.json()).get('items', {})
+    removed = cache.invalidate_books(versions)
+    log_sampled(log, 'Cache invalidated', removed=removed, item_numbers=list(versions))
+    return web.json_response({'invalidated': removed})
+
+
+# Search for items and utilize caching.
+# Concurrent misses for the same query share one catalog request. Search results
+# only list IDs and titles, which a client's writes never change, so the session
+# token is not passed on and every client's misses for the query are shared.
+async def search_items(request):
+    item_name = request.match_info['item_name']
+    cached = cache.get_search(item_name)
+    if cached is not None and cached[2]:
+        log_sampled(log, 'Cache hit', item_name=item_name, cache_entries=len(cache.search))
+        return web.json_response(cached[0])
+
+    session = request.app['session']
+    key = ('search', item_name)
+    if cached is not None and CACHE_STALE_WHILE_REVALIDATE:
+        flights.start(key, lambda: in_background(fetch_search(session, item_name, cached)))
+        log_sampled(log, 'Cache stale, revalidating in the background', item_name=item_name)
+        return web.json_response(cached[0])
+    return web.json_response(await flights.do(key, lambda: fetch_search(session, item_name, cached)))
+
+
+# Fetch /search results from the catalog replicas and cache them. A stale `cached`
+# entry is only fetched again if the catalog changed since. Returns the results,
+# or {'error': ...} if no catalog replica could answer.
+async def fetch_search(session, item_name, cached):
+    try:
+        start_time = time.time()
+        result, headers = await hedged_get(session, f'/search/{item_name}', cached and cached[1])
+        if result is None:
+            cache.revalidated_search(item_name)
+            log_sampled(log, 'Cache revalidated', item_name=item_name, seconds=round(time.time() - start_time, 5))
+            return cached[0]
+        cache.put_search(item_name, result, headers.get('ETag'))
+        log_sampled(log, 'Cache miss', item_name=item_name, cache_entries=len(cache.search),
+                    seconds=round(time.time() - start_time, 5))
+        return result
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log.warning('Error searching the catalog', extra={'item_name': item_name, 'error': str(e)})
+        return {'error': f'Catalog server error: {str(e)}'}
+
+
+# Retrieve information about a book based on the provided item number.
+# Concurrent misses for the same book share one catalog request if their session
+# tokens require the same version of it; only that version is passed on.
+async def book_info(request):
+    item_number = request.match_info['item_number']
+    cached = cache.get_info(item_number)
+    # An entry older than the client's own last write to the book is not used
+    required = parse_token(request.headers.get(SESSION_HEADER)).get(item_number)
+    if cached is not None and cached[0].get('version', 0) < (required or 0):
+        cached = None
+    if cached is not None and cached[2]:
+        log_sampled(log, 'Cache hit', item_number=item_number, cache_entries=len(cache.info))
+        return web.json_response(cached[0])
+
+    session = request.app['session']
+    key = ('info', item_number, required)
+    if cached is not None and CACHE_STALE_WHILE_REVALIDATE:
+        flights.start(key, lambda: in_background(fetch_info(session, item_number, cached, required)))
+        log_sampled(log, 'Cache stale, revalidating in the background', item_number=item_number)
+        return web.json_response(cached[0])
+    return web.json_response(await flights.do(key, lambda: fetch_info(session, item_number, cached, required)))
+
+
+# Fetch a book's info from the catalog replicas and cache it. A stale `cached` entry
+# is only fetched again if the book changed since. With `required`, only a replica
+# that has applied that version of the book answers. Returns the info, or {'error': ...}.
+async def fetch_info(session, item_number, cached, required):
+    try:
+        start_time = time.time()
+        token = format_token({item_number: required}) if required else None
+        result, headers = await hedged_get(session, f'/info/{item_number}', cached and cached[1], token)
+        if result is None:
+            cache.revalidated_info(item_number)
+            log_sampled(log, 'Cache revalidated', item_number=item_number, seconds=round(time.time() - start_time, 5))
+            return cached[0]
+        if 'error' not in result:
+            cache.put_info(item_number, result, headers.get('ETag'))
+        log_sampled(log, 'Cache miss', item_number=item_number, cache_entries=len(cache.info),
+                    seconds=round(time.time() - start_time, 5))
+        return result
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return {'error': f'Catalog server error: {str(e)}'}
+
+
+# Await `coro` without the deadline of the request that started it, for work that
+# outlives the request (it runs in its own task, so this leaves the request alone)
+async def in_background(coro):
+    request_deadline.set(None)
+    return await coro
+
+
+# Retrieve information about several books in one call: /info?ids=1,2,3.
+# Books with a fresh cache entry are answered from the cache; all the others are
+# fetched from the catalog replicas in a single (hedged) request.
+async def books_info(request):
+    item_numbers = list(dict.fromkeys(item_number for item_number in request.query.get('ids', '').split(',') if item_number))
+    token = request.headers.get(SESSION_HEADER)
+    session = parse_token(token)
+    results = {}
+    misses = []
+    for item_number in item_numbers:
+        cached = cache.get_info(item_number)
+        if cached is not None and cached[2] and cached[0].get('version', 0) >= session.get(item_number, 0):
+            results[item_number] = cached[0]
+        else:
+            misses.append(item_number)
+
+    if misses:
+        try:
+            start_time = time.time()
+            fetched, _ = await hedged_get(request.app['session'], f'/info?ids={quote(",".join(misses), safe=",")}',
+                                          token=token)
+            log_sampled(log, 'Bulk info', hits=len(item_numbers) - len(misses), misses=len(misses),
+                        seconds=round(time.time() - start_time, 5))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return web.json_response({'error': f'Catalog server error: {str(e)}'})
+
+        for item_number in misses:
+            result = fetched.get(item_number, {'error': 'Book not found'})
+            if 'error' not in result:
+                cache.put_info(item_number, result)
+            results[item_number] = result
+
+    return web.json_response(results)
+
+
+# List the servers of a group: GET /members/<service>
+async def list_service_members(request):
+    group = {'catalog': catalog_servers, 'order': order_servers}.get(request.match_info['service'])
+    if group is None:
+        return web.json_response({'error': f'Unknown service {request.match_info["service"]}'}, status=404)
+    return web.json_response({'members': group.members()})
+
+
+# A server joins or leaves a group: POST /members/<service>/join or leave with {'url': ...}
+async def change_service_members(request):
+    group = {'catalog': catalog_servers, 'order': order_servers}.get(request.match_info['service'])
+    action = request.match_info['action']
+    url = (await request.json()).get('url')
+    if group is None or action not in ('join', 'leave') or not url:
+        return web.json_response({'error': 'Invalid membership change'}, status=400)
+    if action == 'join':
+        group.join(url)
+    else:
+        group.leave(url)
+    return web.json_response({'members': group.members()})
+
+
+# Serve the metrics in the Prometheus text format.
+async def metrics(request):
+    return web.Response(text=render(), headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+
+# Report cache occupancy, hit/miss/eviction counters and how many misses were coalesced.
+async def cache_stats(request):
+    return web.json_response(dict(cache.stats(), single_flight=flights.stats()))
+
+
+# Report the state of every catalog and order server as seen by the load balancers.
+async def balancer_stats(request):
+    return web.json_response({'catalog': catalog_balancer.stats(), 'order': order_balancer.stats()})
+
+
+# Purchase a book based on the provided item number.
+# The response carries the client's session token, updated with this purchase.
+async def purchase_book(request):
+    item_number = request.match_info['item_number']
+    order_server_url = get_next_order_server()
+    log_sampled(log, 'Purchasing through order server', url=order_server_url)
+
+    try:
+        start_time = time.time()
+        result, headers = await call(request.app['session'], order_balancer, order_server_url, 'POST', f'/purchase/{item_number}')
+        log_sampled(log, 'Purchase', item_number=item_number, seconds=round(time.time() - start_time, 5))
+        token = merge_tokens(request.headers.get(SESSION_HEADER), headers.get(SESSION_HEADER))
+        return web.json_response(result, headers={SESSION_HEADER: token} if token else None)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return web.json_response({'error': f'Order server error: {str(e)}'})
+
+
+# Record the latency and number in flight of every request, by route
+@web.middleware
+async def metrics_middleware(request, handler):
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        REQUEST_DURATION.observe(time.perf_counter() - start, method=request.method, route=route, status=status)
+
+
+# Set the route of every request for its log records and per-route sampling (see common/logs.py)
+@web.middleware
+async def log_route_middleware(request, handler):
+    resource = request.match_info.route.resource
+    token = current_route.set(resource.canonical if resource is not None else None)
+    try:
+        return await handler(request)
+    finally:
+        current_route.reset(token)
+
+
+# Record a span for every request, continuing the caller's trace (see common/tracing.py).
+# Tasks started while handling it inherit the span, so their upstream calls join the trace.
+@web.middleware
+async def tracing_middleware(request, handler):
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else request.path
+    server_span = tracing.start_server_span(f'{request.method} {route}', request.headers.get(tracing.TRACEPARENT_HEADER),
+                                            path=request.path)
+    if server_span is None:
+        return await handler(request)
+    with tracing.use_span(server_span):
+        try:
+            response = await handler(request)
+        except BaseException as e:
+            if isinstance(e, web.HTTPException):
+                server_span.set('status', e.status)
+            server_span.end(e)
+            raise
+    server_span.set('status', response.status)
+    server_span.end()
+    return response
+
+
+# Give every request a deadline of REQUEST_DEADLINE seconds, or less if the caller sent
+# what it has left in DEADLINE_HEADER; a request still running at its deadline is
+# cancelled, together with its upstream calls, and answered 504.
+@web.middleware
+async def deadline_middleware(request, handler):
+    budget = REQUEST_DEADLINE or None
+    try:
+        sent = float(request.headers.get(DEADLINE_HEADER, ''))
+        budget = sent if budget is None else min(budget, sent)
+    except ValueError:
+        pass
+    if budget is None:
+        return await handler(request)
+    if budget <= 0:
+        return web.json_response({'error': 'Deadline exceeded'}, status=504)
+    request_deadline.set(asyncio.get_running_loop().time() + budget)
+    try:
+        return await asyncio.wait_for(handler(request), budget)
+    except asyncio.TimeoutError:
+        return web.json_response({'error': 'Deadline exceeded'}, status=504)
+
+
+# One pooled client session per process, opened and closed with the app
+async def client_session(app):
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE)
+    app['session'] = aiohttp.ClientSession(connector=connector,
+                                           timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+    yield
+    await app['session'].close()
+
+
+def create_app():
+    # Structured log records, written off the event loop (see common/logs.py)
+    setup_logging('frontend')
+    app = web.Application(middlewares=[metrics_middleware, log_route_middleware, tracing_middleware,
+                                       deadline_middleware])
+    app.cleanup_ctx.append(client_session)
+    app.add_routes([
+        web.post('/invalidate_cache', invalidate_cache_batch),
+        web.post('/invalidate_cache/{item_number}', invalidate_cache),
+        web.get('/search/{item_name}', search_items),
+        web.get('/info/{item_number}', book_info),
+        web.get('/info', books_info),
+        web.get('/metrics', metrics),
+        web.get('/cache_stats', cache_stats),
+        web.get('/balancer_stats', balancer_stats),
+        web.post('/purchase/{item_number}', purchase_book),
+        web.get('/members/{service}', list_service_members),
+        web.post('/members/{service}/{action}', change_service_members),
+    ])
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host='0.0.0.0', port=int(os.environ.get('PORT', '5002')))
@@ -0,0 +1,253 @@
+import json
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+
+# Approximate size of a cached value, as the length of its JSON encoding
+def json_size(value):
+    return len(json.dumps(value, separators=(',', ':')))
+
+
+# Thread-safe LRU cache bounded by entry count and total size, with optional TTL.
+#
+# When a new entry does not fit, least recently used entries are evicted one at
+# a time until it does. Entries older than their TTL are dropped on access.
+# `ttl` is the default time to live in seconds (None = no expiry); put() can
+# override it per entry. `on_remove(key, value)` is called, with the cache lock
+# held, whenever an entry leaves the cache for any reason.
+class LRUCache:
+    def __init__(self, max_entries=100, max_bytes=None, ttl=None, sizeof=json_size, on_remove=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.on_remove = on_remove
+        self.lock = threading.RLock()
+        # key -> (value, size, expires_at or None)
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.peek(key) is not None
+
+    # Return the cached value (marking it most recently used) or None, counting a hit or miss
+    def get(self, key):
+        with self.lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    # Return the cached value without touching LRU order or the hit/miss counters
+    def peek(self, key):
+        with self.lock:
+            entry = self._live_entry(key)
+            return None if entry is None else entry[0]
+
+    def put(self, key, value, ttl=None):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self.lock:
+            self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                # Larger than the whole cache: do not cache it at all
+                return
+            while self._entries and (len(self._entries) >= self.max_entries or
+                                     (self.max_bytes is not None and self.bytes + size > self.max_bytes)):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+            self._entries[key] = (value, size, expires_at)
+            self.bytes += size
+
+    # Remove a key; returns the value it held or None
+    def pop(self, key):
+        with self.lock:
+            entry = self._remove(key)
+            return None if entry is None else entry[0]
+
+    def clear(self):
+        with self.lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+    def _live_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+            if self.on_remove is not None:
+                self.on_remove(key, entry[0])
+        return entry
+
+
+# IDs (as strings) of the books listed in a /search result
+def book_ids(results):
+    if not isinstance(results, list):
+        return set()
+    return {str(book['id']) for book in results if isinstance(book, dict) and 'id' in book}
+
+
+# Frontend cache with separate namespaces for /info and /search results.
+#
+# Info entries are keyed by item number and search entries by query, so the two
+# can no longer collide. A reverse index maps each book ID to the search queries
+# whose cached results contain it, so invalidating a book drops exactly its info
+# entry and the search results that list it.
+#
+# Invalidations may carry the version the book was changed to. The highest one
+# seen per book is remembered: older or repeated invalidations are ignored, an
+# info entry that is already at least that new is kept, and info read from a
+# replica that has not caught up with that version yet is not cached.
+#
+# Entries also keep the ETag the catalog sent with them. Once an entry was last
+# checked more than `revalidate_after` seconds ago (None = never) the lookups
+# report it as stale; the caller can then ask the catalog with If-None-Match and,
+# on 304 Not Modified, keep serving it via revalidated_info/revalidated_search.
+class CatalogCache:
+    def __init__(self, max_entries=100, max_bytes=None, ttl=None, revalidate_after=None):
+        self.revalidate_after = revalidate_after
+        # Entries are (result, etag, checked_at)
+        self.info = LRUCache(max_entries, max_bytes, ttl)
+        self.search = LRUCache(max_entries, max_bytes, ttl, on_remove=self._unindex_search)
+        # book ID (str) -> search keys whose cached results contain it; guarded by search.lock
+        self._search_keys_by_book = defaultdict(set)
+        # book ID (str) -> highest version invalidated so far
+        self._latest = {}
+        self.lock = threading.RLock()
+        self.revalidations = 0
+
+    def __len__(self):
+        return len(self.info) + len(self.search)
+
+    # Cached /info result for an item as (result, etag, fresh), or None
+    def get_info(self, item_number):
+        return self._lookup(self.info, str(item_number))
+
+    def put_info(self, item_number, value, etag=None):
+        book_id = str(item_number)
+        with self.lock:
+            if value.get('version', 0) < self._latest.get(book_id, 0):
+                return
+            self.info.put(book_id, (value, etag, time.monotonic()))
+
+    # Cached /search result for a query as (results, etag, fresh), or None
+    def get_search(self, query):
+        return self._lookup(self.search, query)
+
+    def put_search(self, query, results, etag=None):
+        with self.search.lock:
+            self.search.put(query, (results, etag, time.monotonic()))
+            if query in self.search:
+                for book_id in book_ids(results):
+                    self._search_keys_by_book[book_id].add(query)
+
+    # The catalog confirmed a stale entry is unchanged (304): serve it as fresh again
+    def revalidated_info(self, item_number):
+        book_id = str(item_number)
+        with self.lock:
+            entry = self.info.peek(book_id)
+            if entry is not None:
+                self.info.put(book_id, (entry[0], entry[1], time.monotonic()))
+                self.revalidations += 1
+
+    def revalidated_search(self, query):
+        with self.search.lock:
+            entry = self.search.peek(query)
+            if entry is not None:
+                self.put_search(query, entry[0], entry[1])
+                self.revalidations += 1
+
+    # Drop the cached info for a book and every cached search result listing it,
+    # unless `version` is given and is not newer than what the cache already knows.
+    # Returns the number of entries removed.
+    def invalidate_book(self, item_number, version=None):
+        book_id = str(item_number)
+        with self.lock:
+            if version is not None:
+                version = int(version)
+                if version <= self._latest.get(book_id, 0):
+                    return 0
+                self._latest[book_id] = version
+            removed = 0
+            cached = self.info.peek(book_id)
+            if cached is not None and (version is None or cached[0].get('version', 0) < version):
+                self.info.pop(book_id)
+                removed += 1
+            with self.search.lock:
+                for query in list(self._search_keys_by_book.get(book_id, ())):
+                    if self.search.pop(query) is not None:
+                        removed += 1
+            return removed
+
+    # Apply a batch of invalidations, {item_number: version}; returns the number of entries removed
+    def invalidate_books(self, versions):
+        return sum(self.invalidate_book(item_number, version) for item_number, version in versions.items())
+
+    def stats(self):
+        return {'info': self.info.stats(), 'search': self.search.stats(), 'revalidations': self.revalidations}
+
+    # The cache counters as metric families for common.metrics.collect(), labelled by namespace
+    def metric_families(self):
+        stats = {'info': self.info.stats(), 'search': self.search.stats()}
+        families = []
+        for name, metric_type, documentation, field in (
+                ('frontend_cache_hits_total', 'counter', 'Cache lookups answered from the cache', 'hits'),
+                ('frontend_cache_misses_total', 'counter', 'Cache lookups not found in the cache', 'misses'),
+                ('frontend_cache_evictions_total', 'counter', 'Entries evicted to make room', 'evictions'),
+                ('frontend_cache_expirations_total', 'counter', 'Entries dropped after their TTL', 'expirations'),
+                ('frontend_cache_entries', 'gauge', 'Entries in the cache', 'entries'),
+                ('frontend_cache_bytes', 'gauge', 'Approximate size of the cached values', 'bytes')):
+            families.append((name, metric_type, documentation,
+                             [({'namespace': namespace}, values[field]) for namespace, values in stats.items()]))
+        families.append(('frontend_cache_revalidations_total', 'counter',
+                         'Stale entries the catalog confirmed unchanged', [({}, self.revalidations)]))
+        return families
+
+    def _lookup(self, cache, key):
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        result, etag, checked_at = entry
+        fresh = self.revalidate_after is None or time.monotonic() - checked_at < self.revalidate_after
+        return result, etag, fresh
+
+    def _unindex_search(self, query, entry):
+        for book_id in book_ids(entry[0]):
+            keys = self._search_keys_by_book.get(book_id)
+            if keys is not None:
+                keys.discard(query)
+                if not keys:
+                    del self._search_keys_by_book[book_id]
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+
+log = logging.getLogger(__name__)
+
+
+# Request coalescing ("single flight") for threaded servers.
+#
+# The first caller of do(key, fn) runs fn(); callers that ask for the same key
+# while it runs block until it is done and get the same result, or the same
+# exception, instead of running fn() themselves. start(key, fn) runs fn() on a
+# background thread unless a call for the key is already in flight, e.g. to
+# refresh a stale cache entry while it is still being served.
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> Future of the call in flight
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if leader:
+            return self._run(key, future, fn)
+        return future.result()
+
+    # Run fn() in the background for `key`; returns False if a call for it is already in flight
+    def start(self, key, fn):
+        with self.lock:
+            if key in self._calls:
+                return False
+            future = self._calls[key] = Future()
+            self.calls += 1
+        threading.Thread(target=self._run_quietly, args=(key, future, fn), daemon=True).start()
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {'in_flight': len(self._calls), 'calls': self.calls, 'coalesced': self.coalesced}
+
+    def _run(self, key, future, fn):
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, future)
+            future.set_exception(e)
+            raise
+        self._finish(key, future)
+        future.set_result(result)
+        return result
+
+    def _run_quietly(self, key, future, fn):
+        try:
+            self._run(key, future, fn)
+        except Exception as e:
+            log.warning('Background call failed', extra={'key': key, 'error': str(e)})
+
+    def _finish(self, key, future):
+        with self.lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+
+# Request coalescing for asyncio servers, with the same do() and start() as SingleFlight.
+#
+# The shared call runs as its own task and every caller awaits it shielded, so a
+# caller that is cancelled (e.g. at its deadline) does not cancel it for the others.
+class AsyncSingleFlight:
+    def __init__(self):
+        # key -> task of the call in flight
+        self._tasks = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    # Await make_coro() for `key`, or the call for it already in flight
+    async def do(self, key, make_coro):
+        task = self._tasks.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = self._launch(key, make_coro)
+        return await asyncio.shield(task)
+
+    # Run make_coro() in the background for `key`; returns False if a call for it is already in flight
+    def start(self, key, make_coro):
+        if key in self._tasks:
+            return False
+        self._launch(key, make_coro).add_done_callback(lambda done: self._report(key, done))
+        return True
+
+    def stats(self):
+        return {'in_flight': len(self._tasks), 'calls': self.calls, 'coalesced': self.coalesced}
+
+    def _launch(self, key, make_coro):
+        task = self._tasks[key] = asyncio.ensure_future(make_coro())
+        self.calls += 1
+        task.add_done_callback(lambda done: self._finish(key, done))
+        return task
+
+    def _finish(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # Retrieve the exception in case every caller was cancelled before it came
+        if not task.cancelled():
+            task.exception()
+
+    # Log the failure of a background call; retrieving it also keeps asyncio from reporting it as unhandled
+    def _report(self, key, task):
+        if not task.cancelled() and task.exception() is not None:
+            log.warning('Background call failed', extra={'key': key, 'error': str(task.exception())})
@@ -1,160 +1,201 @@
 from flask import Flask, jsonify, request
-import csv
 import requests
+import logging
 import os
-from datetime import datetime
-import threading
+import sys
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import http_client
+from common.config import url_list
+from common.serving import serve
+from common.resilience import DeadlineExceeded, propagate_deadlines
+from common.metrics import instrument
+from common.logs import log_routes, setup_logging
+from common.tracing import span, trace_requests
+from common.invalidation import FRONTEND_URLS
+from common.membership import Membership, add_membership_routes
+from common.session import SESSION_HEADER, format_token
+from order_log import OrderLog
+from peer_notifier import PeerNotifier
+from purchase_pipeline import PurchasePipeline
 
 app = Flask(__name__)
+log = logging.getLogger('order')
 
-CATALOG_SERVER_URL = os.environ.get('CATALOG_SERVER_URL', 'http://localhost:5000')
-REPLICA_SERVER_URL = os.environ.get('REPLICA_SERVER_URL', 'http://localhost:5004')
-
-# Threading and shared resources
-lock = threading.Lock()
-
-# Retrieve catalog information from the catalog server
-def get_catalog():
-    try:
-        url = f'{CATALOG_SERVER_URL}/catalog'
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Error connecting to catalog server: {e}")
-        print(f"URL: {url}")
-        return None
+# Latency and in-flight metrics for every route, served at /metrics
+instrument(app)
 
-# Notify the catalog server about the purchase and update stock quantity
-def notify_catalog_server(item_number):
-    try:
-        catalog = get_catalog()
+# Every request gets a deadline that bounds the calls it makes to other servers
+propagate_deadlines(app)
 
-        if catalog is None:
-            return jsonify({'error': 'Error retrieving catalog information'})
+# Every order replica runs this same server; its identity, data files and peers come from the environment.
 
-        for book in catalog:
-            if str(book['ID']) == item_number:
-                current_quantity = int(book.get('Quantity', 0))
-                if current_quantity > 0:
-                    update_response = requests.put(f'{CATALOG_SERVER_URL}/update/{item_number}', json={'quantity': current_quantity - 1})
+# Identity of this server, used in log lines
+replica_server_id = int(os.environ.get('REPLICA_SERVER_ID', '1'))
+replica_server_port = int(os.environ.get('PORT', '5001'))
 
-                    if update_response.status_code == 200:
-                        print(f"Catalog server updated successfully: {update_response.json()['message']}")
-                    else:
-                        print(f"Error updating catalog server: {update_response.json()['error']}")
-                    return jsonify({'message': f'Book {book.get("Title", "Unknown Title")} purchased successfully'})
+# Structured log records, written off the request threads (see common/logs.py)
+setup_logging(f'order{replica_server_id}')
+log_routes(app)
 
-                else:
-                    return jsonify({'error': 'Book out of stock'})
+# A span for every request, continuing the caller's trace (see common/tracing.py)
+trace_requests(app, f'order{replica_server_id}')
 
-        return jsonify({'error': 'Book not found'}), 404
+# URL the other servers reach this one at; also the origin of the orders taken here
+SELF_URL = os.environ.get('ADVERTISED_URL', f'http://localhost:{replica_server_port}').rstrip('/')
 
-    except requests.exceptions.RequestException as e:
-        print(f"Error connecting to catalog server: {e}")
-        return jsonify({'error': f'Error connecting to catalog server: {e}'}), 500
+# Stock is always taken on the same catalog server, so concurrent purchases of a book cannot conflict
+CATALOG_SERVER_URL = os.environ.get('CATALOG_SERVER_URL', 'http://localhost:5000')
 
-# Verify if the book with a given ID is in stock
-def verify_stock(item_id):
-    try:
-        url = f'{CATALOG_SERVER_URL}/verify/{item_id}'
-        response = requests.post(url)
-        response.raise_for_status()
-        result = response.json()
+# Order history of this replica: ORDER_CSV plus a journal of the orders recorded since its last compaction
+ORDER_CSV = os.environ.get('ORDER_CSV', 'order.csv')
+ORDER_JOURNAL = os.environ.get('ORDER_JOURNAL', os.path.splitext(ORDER_CSV)[0] + '.journal')
 
-        if 'message' in result and result['message'] == 'Book is in stock':
-            return True
-        else:
-            return False
+orders = OrderLog(ORDER_CSV, ORDER_JOURNAL,
+                  fsync_interval=float(os.environ.get('JOURNAL_FSYNC_INTERVAL', '0.005')),
+                  compact_every=int(os.environ.get('JOURNAL_COMPACT_EVERY', '1000')),
+                  origin=SELF_URL)
 
-    except requests.exceptions.RequestException as e:
-        print(f"Error verifying stock with catalog server: {e}")
-        print(f"URL: {url}")
-        return False
+# Default and largest page size of GET /orders
+ORDER_PAGE_SIZE = int(os.environ.get('ORDER_PAGE_SIZE', '100'))
+ORDER_PAGE_MAX = int(os.environ.get('ORDER_PAGE_MAX', '1000'))
 
-# Invalidate the cache in the frontend server for the given item number
-def invalidate_frontend_cache(item_number):
+# Take stock for a batch of purchases in one call; counts maps item numbers to units wanted.
+# Returns the catalog's per-item results, or None if the catalog server could not be reached.
+def decrement_stock(counts):
     try:
-        frontend_url = 'http://localhost:5002'
-        response = requests.post(f'{frontend_url}/invalidate_cache/{item_number}')
+        url = f'{CATALOG_SERVER_URL}/decrement_batch'
+        response = http_client.post(url, json={'items': counts})
         response.raise_for_status()
-        print(f'Cache invalidated successfully in the frontend server for item {item_number}')
+        return response.json()
     except requests.exceptions.RequestException as e:
-        print(f"Error invalidating cache in the frontend server: {e}")
-
-# Update the 'order.csv' file with the given orders
-def update_orders_csv(orders, filename='order.csv'):
-    with open(filename, 'w', newline='') as csvfile:
-        fieldnames = list(orders[0].keys()) if orders else ['item_number', 'timestamp']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(orders)
-
-# Notify the other replica about the purchase and update the order file
-def notify_other_replica(item_number, filename='order_replica.csv'):
-    try:
-        with lock:
-            orders = []
-            if os.path.exists(filename):
-                with open(filename, 'r') as csvfile:
-                    reader = csv.DictReader(csvfile)
-                    for row in reader:
-                        orders.append(row)
-
-            catalog = get_catalog()
-            if catalog is None:
-                return jsonify({'error': 'Error retrieving catalog information'})
-
-            for book in catalog:
-                if str(book['ID']) == item_number:
-                    orders.append({'item_number': item_number, 'timestamp': datetime.utcnow().isoformat()})
-                    update_orders_csv(orders, filename)
-
-                    other_replica_url = f'{REPLICA_SERVER_URL}/notify_purchase/{item_number}'
-                    response = requests.post(other_replica_url)
-                    response.raise_for_status()
+        log.error('Error decrementing stock with catalog server', extra={'url': url, 'error': str(e)})
+        return None
 
-                    return jsonify({'message': f'Book {book.get("Title", "Unknown Title")} purchased successfully'})
+# One background notifier per peer sends it the orders taken here, all in parallel: peer URL -> notifier
+peer_notifiers = {}
+
+# A new notifier asks the peer how far it got, so a peer that joins (or rejoins) gets every order it missed
+def start_notifying(url):
+    stop_notifying(url)
+    peer_notifiers[url] = PeerNotifier(orders, url, SELF_URL)
+
+def stop_notifying(url):
+    notifier = peer_notifiers.pop(url, None)
+    if notifier is not None:
+        notifier.stop()
+
+# The other order servers. ORDER_PEER_URLS seeds the group; replicas can join and
+# leave at runtime (see common/membership.py), and the frontends are told.
+membership = Membership('order', SELF_URL, url_list('ORDER_PEER_URLS', 'http://localhost:5001,http://localhost:5004'),
+                        observers=FRONTEND_URLS, on_join=start_notifying, on_leave=stop_notifying)
+add_membership_routes(app, membership)
+
+# Tell the other replicas' notifiers about new orders so that they send them on.
+# Returns at once; the peers are sent the orders in the background (see peer_notifier.py).
+def notify_other_replicas(new_orders):
+    for notifier in list(peer_notifiers.values()):
+        notifier.wake()
+
+# Record a batch of purchases taken by another replica:
+# {'origin': its ID, 'orders': [{'item_number', 'timestamp', 'seq': the order's seq there}]}.
+# Orders already recorded from that replica are skipped. Answers with the last seq
+# recorded from it (-1 if none), which the replica sends on from.
+@app.route('/notify_purchases', methods=['POST'])
+def notify_purchases():
+    try:
+        data = request.get_json()
+        new_orders = data.get('orders', [])
+        applied = orders.record_received(data['origin'], new_orders)
 
-        return jsonify({'error': 'Book not found in the catalog'})
+        return jsonify({'message': f'Purchase notification received for {len(new_orders)} orders',
+                        'applied': applied})
 
     except Exception as e:
-        return jsonify({'error': f'Error notifying other replica: {e}'}), 500
-
-# Purchase a book and update relevant files
+        return jsonify({'error': f'Error processing purchase notification: {e}'}), 500
+
+# Process a batch of purchases: one stock decrement on the catalog server for the
+# whole batch, then one durable write for the orders that got stock. The catalog
+# server invalidates the frontend caches for the books it decremented.
+# Returns one (result, session token) pair per purchase, in order; the token names
+# the version the purchase left the book at and is None if nothing was bought.
+def process_purchases(item_numbers):
+    stock = decrement_stock(dict(Counter(item_numbers)))
+    if stock is None:
+        return [({'error': 'Error connecting to catalog server'}, None) for _ in item_numbers]
+
+    results = []
+    purchased = []
+    for item_number in item_numbers:
+        result = stock.get(item_number, {'error': 'Book not found'})
+        if 'error' in result:
+            results.append(({'error': 'Book not found in the catalog'}, None))
+        elif result['granted'] > 0:
+            result['granted'] -= 1
+            purchased.append(item_number)
+            results.append(({'message': f'Book {result.get("title", "Unknown Title")} purchased successfully'},
+                            format_token({item_number: result['version']}) if 'version' in result else None))
+        else:
+            results.append(({'error': 'Book out of stock'}, None))
+
+    with span('record orders', count=len(purchased)):
+        new_orders = orders.record_many(purchased)
+    if new_orders:
+        notify_other_replicas(new_orders)
+
+    return results
+
+# Concurrent purchases are grouped into batches by a single pipeline worker
+purchases = PurchasePipeline(process_purchases,
+                             max_batch_size=int(os.environ.get('PURCHASE_BATCH_SIZE', '32')),
+                             max_wait=float(os.environ.get('PURCHASE_BATCH_WAIT', '0.002')))
+
+# Order history, oldest first, answered from the in-memory indexes of the order log.
+# Optional query parameters: item=N  since=T  until=T (ISO timestamps, until exclusive)
+# offset=N  limit=N. The number of matching orders is returned in X-Total-Count.
+@app.route('/orders', methods=['GET'])
+def order_history():
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', ORDER_PAGE_SIZE, type=int), 0), ORDER_PAGE_MAX)
+    total, page = orders.history(request.args.get('item'), request.args.get('since'), request.args.get('until'),
+                                 offset, limit)
+    response = jsonify(page)
+    response.headers['X-Total-Count'] = str(total)
+    return response
+
+# Number of orders per item number: {item_number: count}. Optional since=T and until=T as for /orders.
+@app.route('/sales', methods=['GET'])
+def sales_counts():
+    return jsonify(orders.sales_counts(request.args.get('since'), request.args.get('until')))
+
+# Number of orders of one item number. Optional since=T and until=T as for /orders.
+@app.route('/sales/<item_number>', methods=['GET'])
+def sales_count(item_number):
+    count = orders.sales_count(item_number, request.args.get('since'), request.args.get('until'))
+    return jsonify({'item_number': item_number, 'count': count})
+
+# Liveness check used by the frontends' load balancers
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({'status': 'ok'})
+
+# Purchase a book; the purchase is committed together with any concurrent ones.
+# A successful purchase returns the session token for it in SESSION_HEADER. A purchase
+# still waiting for its batch at the request's deadline is answered 504.
 @app.route('/purchase/<item_number>', methods=['POST'])
 def purchase_book(item_number):
-    if not verify_stock(item_number):
-        return jsonify({'error': 'Book out of stock'})
-
-    orders_csv_file = 'order.csv'
-    orders = []
-
-    if os.path.exists(orders_csv_file):
-        with open(orders_csv_file, 'r') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                orders.append(row)
-
-    catalog = get_catalog()
-    if catalog is None:
-        return jsonify({'error': 'Error retrieving catalog information'})
-
-    for book in catalog:
-        if str(book['ID']) == item_number:
-            orders.append({'item_number': item_number, 'timestamp': datetime.utcnow().isoformat()})
-            update_orders_csv(orders)
-            notify_other_replica(item_number, 'order_replica.csv')
-            invalidate_frontend_cache(item_number)
-            notify_catalog_server(item_number)
-
-            return jsonify({'message': f'Book {book.get("Title", "Unknown Title")} purchased successfully'})
-
-    return jsonify({'error': 'Book not found in the catalog'})
+    try:
+        result, token = purchases.submit(item_number)
+    except DeadlineExceeded:
+        return jsonify({'error': 'Deadline exceeded'}), 504
+    response = jsonify(result)
+    if token is not None:
+        response.headers[SESSION_HEADER] = token
+    return response
 
 
 if __name__ == '__main__':
-    replica_server_id = 1
-    replica_server_port = 5001
-    print(f'Replica {replica_server_id} on Port {replica_server_port}: Order Server Running')
-    app.run(host='0.0.0.0', port=replica_server_port, debug=True)
+    log.info('Order server running', extra={'port': replica_server_port})
+    membership.announce()
+    serve(app, replica_server_port)
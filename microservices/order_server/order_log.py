@@ -0,0 +1,199 @@
+import csv
+import os
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from datetime import datetime
+from common.journal import Journal, atomic_write
+
+FIELDNAMES = ['item_number', 'timestamp', 'origin', 'origin_seq']
+
+
+# Order history stored as a CSV of compacted orders plus a journal of newer ones.
+#
+# Recording an order is a single journal append, so its cost does not grow with
+# the history. Every `compact_every` orders the journaled orders are appended to
+# the CSV and the journal is emptied. Each order carries its position in the
+# history ('seq'), so orders already in the CSV are skipped on replay.
+#
+# Every order also names the server that took it ('origin') and its seq there
+# ('origin_seq'). Orders taken by other servers are recorded with record_received(),
+# which skips the ones already recorded, so a peer can always send its orders again.
+# Orders with no origin predate this and are never sent to peers.
+#
+# The whole history is also kept in memory, indexed by timestamp and by item
+# number, so history pages and sales counts are answered with a few bisections
+# instead of a scan. Queries hold the lock only while they copy their result,
+# so they never hold up purchases for long.
+class OrderLog:
+    def __init__(self, csv_filename, journal_filename, fsync_interval=0.005, compact_every=1000, origin=None):
+        self.csv_filename = csv_filename
+        # ID of this server, the origin of the orders recorded with record_many()
+        self.origin = origin
+        self.lock = threading.Lock()
+        self.journal = Journal(journal_filename, fsync_interval, compact_every)
+        # Every order, by seq
+        self._orders = []
+        # Sorted (timestamp, seq) keys of all orders, and of the orders of each item number
+        self._by_time = []
+        self._by_item = defaultdict(list)
+        # Seqs of the orders taken on this server, and the last origin_seq recorded from each other server
+        self._local = []
+        self.received = {}
+        for order in self._read_csv():
+            self._index(order)
+        self.compacted = len(self._orders)
+        self.pending = [order for order in self.journal.replay() if order['seq'] >= self.compacted]
+        for order in self.pending:
+            self._index(order)
+        self.count = self.compacted + len(self.pending)
+
+    def _read_csv(self):
+        if not os.path.exists(self.csv_filename):
+            with open(self.csv_filename, 'w', newline='') as csvfile:
+                csv.DictWriter(csvfile, fieldnames=FIELDNAMES).writeheader()
+            return []
+        with open(self.csv_filename, 'r') as csvfile:
+            reader = csv.DictReader(csvfile)
+            orders = [{'seq': seq, 'item_number': row['item_number'], 'timestamp': row['timestamp'],
+                       'origin': row.get('origin') or None,
+                       'origin_seq': int(row['origin_seq']) if row.get('origin_seq') else None}
+                      for seq, row in enumerate(reader)]
+        # A CSV written before orders had an origin gets the new columns, so compaction can append to it
+        if reader.fieldnames != FIELDNAMES:
+            def write(csvfile):
+                writer = csv.DictWriter(csvfile, fieldnames=FIELDNAMES, extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows(orders)
+
+            atomic_write(self.csv_filename, write)
+        return orders
+
+    def _index(self, order):
+        key = (order['timestamp'], order['seq'])
+        self._orders.append(order)
+        # Orders mostly arrive in timestamp order, so these inserts are usually appends
+        insort(self._by_time, key)
+        insort(self._by_item[str(order['item_number'])], key)
+        origin = order.get('origin')
+        if origin is not None and origin == self.origin:
+            self._local.append(order['seq'])
+        elif origin is not None:
+            self.received[origin] = max(order['origin_seq'], self.received.get(origin, -1))
+
+    # Record an order and return it once it is durable
+    def record(self, item_number, timestamp=None):
+        return self.record_many([item_number], [timestamp])[0]
+
+    # Record several orders taken on this server with a single journal write and fsync;
+    # returns them once durable
+    def record_many(self, item_numbers, timestamps=None):
+        if not item_numbers:
+            return []
+        timestamps = timestamps or [None] * len(item_numbers)
+        with self.lock:
+            new_orders = []
+            for item_number, timestamp in zip(item_numbers, timestamps):
+                new_orders.append({
+                    'seq': self.count,
+                    'item_number': item_number,
+                    'timestamp': timestamp or datetime.utcnow().isoformat(),
+                    'origin': self.origin,
+                    'origin_seq': self.count
+                })
+                self.count += 1
+            seq = self._append(new_orders)
+        self._wait_durable(seq)
+        return new_orders
+
+    # Record orders taken by the server `origin` ({'item_number', 'timestamp', 'seq': its
+    # seq there}, in seq order), skipping the ones already recorded from it. Returns the
+    # last seq recorded from `origin` (-1 if none) once those orders are durable.
+    def record_received(self, origin, orders):
+        with self.lock:
+            last = self.received.get(origin, -1)
+            new_orders = []
+            for order in orders:
+                if order['seq'] <= last:
+                    continue
+                last = order['seq']
+                new_orders.append({
+                    'seq': self.count,
+                    'item_number': order['item_number'],
+                    'timestamp': order.get('timestamp') or datetime.utcnow().isoformat(),
+                    'origin': origin,
+                    'origin_seq': order['seq']
+                })
+                self.count += 1
+            # With nothing new, still wait for whatever is being written (e.g. the same
+            # orders, sent again while the first request was still waiting for its fsync)
+            seq = self._append(new_orders) if new_orders else self.journal.appended_seq
+        self._wait_durable(seq)
+        return last
+
+    # Up to `limit` of the orders taken on this server after its seq `after`, oldest first
+    def local_since(self, after, limit):
+        with self.lock:
+            start = bisect_right(self._local, after)
+            return [dict(self._orders[seq]) for seq in self._local[start:start + limit]]
+
+    # Index and journal new orders; the caller holds the lock, so 'seq' matches the journal order
+    def _append(self, new_orders):
+        self.pending.extend(new_orders)
+        for order in new_orders:
+            self._index(order)
+        return self.journal.append_many(new_orders, durable=False)
+
+    def _wait_durable(self, seq):
+        self.journal.wait_durable(seq)
+        if self.journal.needs_compaction():
+            self.compact()
+
+    # Move the journaled orders into the CSV and empty the journal
+    def compact(self):
+        with self.lock:
+            self.journal.compact(self._append_pending_to_csv)
+
+    def _append_pending_to_csv(self):
+        with open(self.csv_filename, 'a', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=FIELDNAMES, extrasaction='ignore')
+            writer.writerows(self.pending)
+            csvfile.flush()
+            os.fsync(csvfile.fileno())
+        self.compacted += len(self.pending)
+        self.pending = []
+
+    # Orders in timestamp order, optionally only those of `item_number` and those with
+    # since <= timestamp < until (ISO timestamps). Returns (total matching, the page
+    # of at most `limit` orders starting at `offset`).
+    def history(self, item_number=None, since=None, until=None, offset=0, limit=100):
+        with self.lock:
+            keys = self._by_time if item_number is None else self._by_item.get(str(item_number), [])
+            start, end = _time_range(keys, since, until)
+            first = start + offset
+            page = [dict(self._orders[seq]) for _, seq in keys[first:max(min(first + limit, end), first)]]
+            return end - start, page
+
+    # Number of orders per item number, optionally only those with since <= timestamp < until
+    def sales_counts(self, since=None, until=None):
+        with self.lock:
+            counts = {}
+            for item_number, keys in self._by_item.items():
+                start, end = _time_range(keys, since, until)
+                if end > start:
+                    counts[item_number] = end - start
+            return counts
+
+    # Number of orders of one item number, optionally only those with since <= timestamp < until
+    def sales_count(self, item_number, since=None, until=None):
+        with self.lock:
+            start, end = _time_range(self._by_item.get(str(item_number), []), since, until)
+            return end - start
+
+
+# Positions in sorted (timestamp, seq) keys of the first key at or after `since`
+# and of the first key at or after `until`; None leaves that end open
+def _time_range(keys, since, until):
+    start = 0 if since is None else bisect_left(keys, (since,))
+    end = len(keys) if until is None else bisect_left(keys, (until,))
+    return start, max(start, end)
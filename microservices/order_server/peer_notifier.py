@@ -0,0 +1,75 @@
+import logging
+import os
+import threading
+import time
+
+from common import http_client
+
+log = logging.getLogger(__name__)
+
+# Seconds to wait before retrying a peer that could not be reached or failed
+NOTIFY_RETRY_INTERVAL = float(os.environ.get('NOTIFY_RETRY_INTERVAL', '1.0'))
+
+# Largest number of orders sent to a peer in one request
+NOTIFY_BATCH_SIZE = int(os.environ.get('NOTIFY_BATCH_SIZE', '500'))
+
+
+# Sends the orders taken on this server to one peer's POST /notify_purchases from
+# a background thread; every peer has its own notifier, so purchases never wait for
+# a peer's write and a slow peer never holds up the others.
+#
+# The orders are read from the OrderLog, not queued in memory, so nothing is lost
+# while a peer is away. `acked` is the seq of the last order the peer confirmed
+# it recorded. A new notifier first asks the peer for it with an empty batch, so a
+# peer that restarted or rejoined gets every order it missed, from the journal.
+# The peer skips orders it already recorded (see OrderLog.record_received), so
+# after any failure the batch is simply sent again after NOTIFY_RETRY_INTERVAL seconds.
+class PeerNotifier:
+    def __init__(self, order_log, peer_url, origin):
+        self.order_log = order_log
+        self.peer_url = peer_url
+        self.origin = origin
+        self.acked = -1
+        # Whether the peer has told this notifier how far it got
+        self.synced = False
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    # New orders were recorded; returns at once
+    def wake(self):
+        self.wakeup.set()
+
+    # Stop sending, e.g. because the peer left the group; the orders stay in the log
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def _run(self):
+        while not self.stopped:
+            self.wakeup.clear()
+            # Any failure, including a malformed reply, is retried; the notifier must not die
+            try:
+                sent = self._send()
+            except Exception as e:
+                log.warning('Error notifying peer, will retry', extra={'peer': self.peer_url, 'acked': self.acked,
+                                                                       'error': f'{type(e).__name__}: {e}'})
+                time.sleep(NOTIFY_RETRY_INTERVAL)
+                continue
+            # Wait for new orders once the peer has everything
+            if not sent:
+                self.wakeup.wait()
+
+    # Send the next batch; returns whether there was anything to send
+    def _send(self):
+        batch = self.order_log.local_since(self.acked, NOTIFY_BATCH_SIZE) if self.synced else []
+        if self.synced and not batch:
+            return False
+        orders = [{'item_number': order['item_number'], 'timestamp': order['timestamp'], 'seq': order['origin_seq']}
+                  for order in batch]
+        response = http_client.post(f'{self.peer_url}/notify_purchases', json={'origin': self.origin, 'orders': orders})
+        response.raise_for_status()
+        self.acked = response.json()['applied']
+        self.synced = True
+        return True
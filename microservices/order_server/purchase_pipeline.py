@@ -0,0 +1,90 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from common import tracing
+from common.resilience import DeadlineExceeded, remaining, set_deadline
+
+
+# Group commit for purchases.
+#
+# Request threads submit an item number and block on a Future. A single worker
+# thread drains the queue into batches of at most `max_batch_size` purchases,
+# waiting at most `max_wait` seconds after the first one for more to arrive,
+# and hands each batch to `process_batch`. `process_batch` receives the list of
+# item numbers and must return one result per purchase, in the same order.
+#
+# A batch is processed in a span of the trace of its first purchase; the other
+# purchases' traces are listed in its 'linked_traces' attribute.
+#
+# Request deadlines (see common/resilience.py) carry over to the worker: a batch
+# runs with the tightest deadline of its purchases, so its upstream calls are cut
+# short when the first of them runs out of time. A purchase whose deadline passes
+# while it waits raises DeadlineExceeded in submit(); one whose deadline passed
+# before its batch started is not processed at all.
+class PurchasePipeline:
+    def __init__(self, process_batch, max_batch_size=32, max_wait=0.002):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    # Queue a purchase and wait for its own result, at most until the request's deadline
+    def submit(self, item_number):
+        future = Future()
+        left = remaining()
+        deadline = None if left is None else time.monotonic() + left
+        self.pending.put((item_number, future, tracing.current_span(), deadline))
+        try:
+            return future.result(timeout=left)
+        except TimeoutError:
+            raise DeadlineExceeded(f'Deadline exceeded waiting for the purchase of {item_number}')
+
+    def _next_batch(self):
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._live(self._next_batch())
+            if not batch:
+                continue
+            futures = [future for _, future, _, _ in batch]
+            parents = [parent for _, _, parent, _ in batch if parent is not None]
+            deadlines = [deadline for _, _, _, deadline in batch if deadline is not None]
+            set_deadline(min(deadlines) - time.monotonic() if deadlines else None)
+            try:
+                with tracing.span('purchase batch', parent=parents[0] if parents else None, size=len(batch),
+                                  linked_traces=sorted({parent.trace_id for parent in parents[1:]})):
+                    results = self.process_batch([item_number for item_number, _, _, _ in batch])
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+            finally:
+                set_deadline(None)
+
+    # The purchases of `batch` whose deadline has not passed; the others fail with DeadlineExceeded
+    def _live(self, batch):
+        now = time.monotonic()
+        live = []
+        for purchase in batch:
+            item_number, future, _, deadline = purchase
+            if deadline is not None and deadline <= now:
+                future.set_exception(DeadlineExceeded(f'Deadline exceeded before the purchase of {item_number}'))
+            else:
+                live.append(purchase)
+        return live
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The servers import their own modules by file name and the shared ones from `common`
+MICROSERVICES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[:0] = [MICROSERVICES, os.path.join(MICROSERVICES, 'catalog_server'), os.path.join(MICROSERVICES, 'order_server')]
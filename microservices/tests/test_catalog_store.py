@@ -0,0 +1,58 @@
+import csv
+import random
+
+from catalog_store import FIELDNAMES, CatalogStore
+
+WORDS = ['distributed', 'systems', 'graduate', 'school', 'rpc', 'noobs', 'xen', 'spring', 'cooking', 'dos', 'a', 'ab']
+
+
+def make_store(tmp_path, books):
+    filename = tmp_path / 'catalog.csv'
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=FIELDNAMES)
+        writer.writeheader()
+        for book_id, (title, topic) in enumerate(books, 1):
+            writer.writerow({'ID': book_id, 'Title': title, 'Quantity': 1, 'Price': 1.0, 'Topic': topic, 'Version': 0})
+    store = CatalogStore()
+    store.load(str(filename))
+    return store
+
+
+# The books whose fields contain `query`, found by scanning every book
+def naive_search(store, query, fields):
+    return [book for book in sorted(store._books.values(), key=lambda book: book.id)
+            if any(query.lower() in getattr(book, field).lower() for field in fields)]
+
+
+def random_text(rng):
+    return ' '.join(rng.choice(WORDS).title() if rng.random() < 0.3 else rng.choice(WORDS)
+                    for _ in range(rng.randint(1, 5)))
+
+
+def test_substring_search_matches_naive_scan(tmp_path):
+    rng = random.Random(7)
+    store = make_store(tmp_path, [(random_text(rng), random_text(rng)) for _ in range(200)])
+    queries = ['', 'a', 'S', 'sy', 'sys', 'syst', 'ted sys', 'OOB', 'c', 'zzz', 'dos a', 'g s']
+    queries += [text[start:start + length] for text in (random_text(rng) for _ in range(50))
+                for start, length in [(rng.randint(0, len(text)), rng.randint(1, 8))]]
+    for query in queries:
+        for fields in (['topic'], ['title'], ['topic', 'title']):
+            assert store.search(query, fields) == naive_search(store, query, fields), (query, fields)
+
+
+def test_search_follows_title_and_topic_changes(tmp_path):
+    store = make_store(tmp_path, [('RPCs for Noobs', 'distributed systems'), ('Cooking for the Impatient', 'graduate school')])
+    store.update(1, title='Spring in the Pioneer Valley', topic='graduate school', version=1)
+
+    for query in ['rpc', 'spring', 'valley', 'graduate', 'distributed']:
+        for fields in (['topic'], ['title'], ['topic', 'title']):
+            assert store.search(query, fields) == naive_search(store, query, fields), (query, fields)
+
+
+def test_prefix_search_matches_word_prefixes(tmp_path):
+    store = make_store(tmp_path, [('RPCs for Noobs', 'distributed systems'), ('Xen and the Art', 'distributed systems'),
+                                  ('Cooking for the Impatient', 'graduate school')])
+
+    assert [book.id for book in store.search('dist', ['topic'], 'prefix')] == [1, 2]
+    assert [book.id for book in store.search('for', ['title'], 'prefix')] == [1, 3]
+    assert [book.id for book in store.search('ributed', ['topic'], 'prefix')] == []
@@ -0,0 +1,40 @@
+from common.journal import Journal
+
+
+def test_replay_returns_appended_records(tmp_path):
+    journal = Journal(str(tmp_path / 'test.journal'))
+    journal.append({'id': 1, 'quantity': 5})
+    journal.append_many([{'id': 2, 'quantity': 6}, {'id': 3, 'quantity': 7}])
+
+    assert list(journal.replay()) == [{'id': 1, 'quantity': 5}, {'id': 2, 'quantity': 6}, {'id': 3, 'quantity': 7}]
+
+
+def test_replay_ignores_torn_last_line(tmp_path):
+    filename = tmp_path / 'test.journal'
+    journal = Journal(str(filename))
+    journal.append_many([{'id': 1, 'quantity': 5}, {'id': 2, 'quantity': 6}])
+    # A crash in the middle of the next write leaves part of a line behind
+    with open(filename, 'a', encoding='utf-8') as journal_file:
+        journal_file.write('{"id":3,"quan')
+
+    assert list(Journal(str(filename)).replay()) == [{'id': 1, 'quantity': 5}, {'id': 2, 'quantity': 6}]
+
+
+def test_replay_stops_at_corrupt_line(tmp_path):
+    filename = tmp_path / 'test.journal'
+    filename.write_text('{"id":1}\nnot json\n{"id":2}\n', encoding='utf-8')
+
+    assert list(Journal(str(filename)).replay()) == [{'id': 1}]
+
+
+def test_compact_empties_journal(tmp_path):
+    journal = Journal(str(tmp_path / 'test.journal'), compact_every=2)
+    journal.append_many([{'id': 1}, {'id': 2}])
+    assert journal.needs_compaction()
+
+    snapshots = []
+    journal.compact(lambda: snapshots.append(list(journal.replay())))
+
+    assert snapshots == [[{'id': 1}, {'id': 2}]]
+    assert list(journal.replay()) == []
+    assert not journal.needs_compaction()
@@ -0,0 +1,141 @@
+import pytest
+
+import replication
+from catalog_store import Book
+from replication import AppliedOffsets, ReplicaSender, ReplicationLog
+
+
+def book(book_id, quantity, version):
+    return Book(id=book_id, title=f'Book {book_id}', quantity=quantity, price=1.0, topic='test', version=version)
+
+
+class Response:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f'HTTP {self.status_code}')
+
+
+# Records the requests a sender makes and answers them from `answers`, a list of
+# (path suffix, Response) consumed in order
+class FakePeer:
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.requests = []
+
+    def post(self, url, json=None, **kwargs):
+        path, response = self.answers.pop(0)
+        assert url.endswith(path), (url, path)
+        self.requests.append((path, json))
+        return response
+
+
+@pytest.fixture
+def sender_factory(monkeypatch):
+    # Senders are driven by calling _ship() directly, without their worker thread
+    monkeypatch.setattr(replication.threading.Thread, 'start', lambda thread: None)
+
+    def make(log, peer):
+        monkeypatch.setattr(replication.http_client, 'post', peer.post)
+        return ReplicaSender(log, 'http://peer', 'http://self', lambda: (log.seq, [{'ID': 1}]))
+
+    return make
+
+
+def test_since_returns_deltas_after_offset():
+    log = ReplicationLog()
+    log.append([book(1, 5, 1), book(2, 6, 1)])
+    log.append([book(1, 4, 2)])
+
+    assert [delta['seq'] for delta in log.since(0)] == [1, 2, 3]
+    assert log.since(1) == [{'id': 2, 'quantity': 6, 'price': 1.0, 'version': 1, 'seq': 2},
+                            {'id': 1, 'quantity': 4, 'price': 1.0, 'version': 2, 'seq': 3}]
+    assert log.since(3) == []
+    assert [delta['seq'] for delta in log.since(0, limit=2)] == [1, 2]
+
+
+def test_since_returns_none_once_deltas_are_dropped():
+    log = ReplicationLog(max_entries=3)
+    log.append([book(1, quantity, quantity) for quantity in range(1, 6)])
+
+    assert log.since(0) is None
+    assert log.since(1) is None
+    assert [delta['seq'] for delta in log.since(2)] == [3, 4, 5]
+    assert log.since(5) == []
+
+
+def test_new_sender_resumes_from_offset_peer_reports(sender_factory):
+    log = ReplicationLog()
+    log.append([book(1, quantity, quantity) for quantity in range(1, 6)])
+    peer = FakePeer([('/replicate', Response(200, {'applied': 3})), ('/replicate', Response(200, {'applied': 5}))])
+    sender = sender_factory(log, peer)
+
+    sender._ship()
+    assert peer.requests[0][1]['deltas'] == [] and sender.acked == 3 and sender.synced
+    sender._ship()
+    assert [delta['seq'] for delta in peer.requests[1][1]['deltas']] == [4, 5]
+    assert peer.requests[1][1]['from'] == 3 and sender.acked == 5
+
+
+def test_sender_resumes_from_offset_in_409(sender_factory):
+    log = ReplicationLog()
+    log.append([book(1, quantity, quantity) for quantity in range(1, 6)])
+    peer = FakePeer([('/replicate', Response(200, {'applied': 5})), ('/replicate', Response(409, {'applied': 2})),
+                     ('/replicate', Response(200, {'applied': 5}))])
+    sender = sender_factory(log, peer)
+    sender._ship()
+
+    # The peer restarted and only kept the first two deltas
+    sender._ack(1)
+    sender._ship()
+    assert sender.acked == 2 and sender.synced
+    sender._ship()
+    assert [delta['seq'] for delta in peer.requests[2][1]['deltas']] == [3, 4, 5]
+    assert [path for path, _ in peer.requests] == ['/replicate'] * 3
+
+
+def test_sender_sends_snapshot_to_peer_that_does_not_know_the_stream(sender_factory):
+    log = ReplicationLog()
+    log.append([book(1, 5, 1)])
+    peer = FakePeer([('/replicate', Response(409, {'applied': None})),
+                     ('/replicate_snapshot', Response(200, {'applied': 1}))])
+    sender = sender_factory(log, peer)
+
+    sender._ship()
+    path, data = peer.requests[1]
+    assert path == '/replicate_snapshot'
+    assert data == {'source': 'http://self', 'epoch': log.epoch, 'seq': 1, 'books': [{'ID': 1}]}
+    assert sender.acked == 1 and sender.synced
+
+
+def test_sender_sends_snapshot_when_deltas_were_dropped(sender_factory):
+    log = ReplicationLog(max_entries=2)
+    log.append([book(1, quantity, quantity) for quantity in range(1, 6)])
+    peer = FakePeer([('/replicate', Response(200, {'applied': 1})),
+                     ('/replicate_snapshot', Response(200, {'applied': 5}))])
+    sender = sender_factory(log, peer)
+
+    sender._ship()
+    sender._ship()
+    assert [path for path, _ in peer.requests] == ['/replicate', '/replicate_snapshot']
+    assert sender.acked == 5
+
+
+def test_applied_offsets_survive_save_and_load(tmp_path):
+    offsets = AppliedOffsets()
+    offsets.set('http://a', 'epoch1', 7)
+    offsets.set('http://b', 'epoch2', 0)
+    offsets.save(str(tmp_path / 'offsets.json'))
+
+    loaded = AppliedOffsets()
+    loaded.load(str(tmp_path / 'offsets.json'))
+    assert loaded.get('http://a', 'epoch1') == 7
+    assert loaded.get('http://a', 'epoch2') is None
+    assert loaded.to_dict() == offsets.to_dict()
+    AppliedOffsets().load(str(tmp_path / 'missing.json'))